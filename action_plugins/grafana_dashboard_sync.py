@@ -3,34 +3,168 @@
 
 from ansible.plugins.action import ActionBase
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.errors import AnsibleError, AnsibleParserError
+import copy
+import errno
+import hashlib
+import multiprocessing
 import os
+from collections import OrderedDict
 from glob import glob
 import re
 import json
+import stat
 import tempfile
+import time
 import uuid
 # from datetime import datetime
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def loadRoleModuleUtil(name):
+    """a module_utils file of this role, action plugins can't import them as ansible.module_utils"""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "module_utils", "%s.py" % name)
+    module_name = "ansible_role_grafana_dashboards_%s" % name
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(module_name, path)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# parsing and compact dumps only, files are written with the stdlib json module (see saveJson)
+grafana_json = loadRoleModuleUtil("grafana_json")
+JSON_BACKEND = grafana_json.JSON_BACKEND
+jsonLoads = grafana_json.jsonLoads
+jsonDumps = grafana_json.jsonDumps
+
+# parsed local trees of this process, keyed like treeCachePath
+_TREE_CACHE = {}
+# fewer changed files than this are not worth starting a parse pool for
+PARSE_POOL_MIN_FILES = 32
+# id, title and version lines of a file written by saveJson (indent=4), nestingDelta tells the top-level ones
+HEADER_RE = re.compile(br'\n    "(id|title|version)": ([^\n]*?),?(?=\n)')
+# every byte but the ones that make up the nesting of a JSON document
+NON_NESTING = bytes(bytearray(c for c in range(256) if c not in bytearray(b'"{}[]')))
+
+def nestingDelta(chunk):
+    """how many levels deeper the document is after `chunk`, which has to start outside of a string"""
+    if b'\\' in chunk:
+        chunk = chunk.replace(b'\\\\', b'').replace(b'\\"', b'')
+    # with escaped quotes gone every quote opens or closes a string, dropping
+    # empty ones keeps that so, what is left between quotes is inside strings
+    chunk = chunk.translate(None, NON_NESTING).replace(b'""', b'')
+    chunk = b''.join(chunk.split(b'"')[::2])
+    return chunk.count(b'{') + chunk.count(b'[') - chunk.count(b'}') - chunk.count(b']')
+
+def dashboardHeader(data):
+    """id, title and version of a dashboard without parsing all of it, None unless the file is laid out like saveJson's"""
+    if not data.startswith(b'{\n    "'):
+        return None
+    header = {}
+    depth = 0
+    pos = 0
+    for match in HEADER_RE.finditer(data):
+        # JSON strings can't span lines, so a match (a line break) is never inside one
+        depth += nestingDelta(data[pos:match.start()])
+        pos = match.start()
+        if depth != 1:
+            continue
+        key, value = match.groups()
+        try:
+            header[key.decode('ascii')] = json.loads(value.decode('utf-8'))
+        except ValueError:
+            return None
+    if "id" not in header or "title" not in header:
+        return None
+    return header
+
+def listDir(path):
+    """(name, full path, is_dir, stat or None) of a directory's entries, stat is only taken for files"""
+    if scandir is not None:
+        for entry in scandir(path):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            yield entry.name, entry.path, is_dir, None if is_dir or not entry.is_file() else entry.stat()
+        return
+    for name in os.listdir(path):
+        full_path = os.path.join(path, name)
+        is_dir = os.path.isdir(full_path) and not os.path.islink(full_path)
+        yield name, full_path, is_dir, None if is_dir or not os.path.isfile(full_path) else os.stat(full_path)
+
+def indexDashboardFile(job):
+    """index entry of a new or modified dashboard file, a module-level function so the parse pool can run it
+
+    returns (index entry, parsed dashboard or None, error), the dashboard is only
+    returned with keep_body and when it had to be parsed in full
+    """
+    path, dash_path, mtime, size, entry, keep_body = job
+    file_path = "%s/%s" % (path, dash_path)
+    with open(file_path, "rb") as dash_file:
+        data = dash_file.read()
+    content_hash = hashlib.sha1(data).hexdigest()
+    if entry and entry["hash"] == content_hash:
+        return dict(entry, mtime=mtime, size=size), None, None
+    header = dashboardHeader(data)
+    if header:
+        # the rest of the file is parsed only if the dashboard gets uploaded or rewritten
+        entry = dict(header, mtime=mtime, size=size, hash=content_hash, header_only=True)
+        return entry, None, None
+    try:
+        dash = jsonLoads(data)
+    except Exception as e:
+        return None, None, "Invalid dashboard JSON file at %s: %s" % (file_path, e)
+    if not dash or not isinstance(dash, dict) or "id" not in dash or "title" not in dash:
+        return None, None, "Invalid dashboard %s" % dash_path
+    entry = {"mtime": mtime, "size": size, "hash": content_hash, "title": dash["title"], "id": dash["id"]}
+    if "version" in dash:
+        entry["version"] = dash["version"]
+    return entry, dash if keep_body else None, None
+
+def parsePool(workers):
+    # the plugin module can't be imported by name in spawned processes, fork where start methods exist
+    context = multiprocessing.get_context("fork") if hasattr(multiprocessing, "get_context") else multiprocessing
+    return context.Pool(workers)
+
+def scanJsonFiles(path, prune=(), prefix=""):
+    """yields (relative path, stat) of the *.json files under path in a single pass, directories in `prune` (normalized paths) are skipped"""
+    subdirs = []
+    for name, full_path, is_dir, st in listDir(path):
+        if is_dir:
+            if os.path.normpath(full_path) not in prune:
+                subdirs.append((name, full_path))
+        elif st is not None and name.endswith('.json') and not name.startswith('.'):
+            # glob('*.json') skipped hidden files too
+            yield prefix + name, st
+    # like os.walk, files of a directory come before its subdirectories
+    for name, full_path in subdirs:
+        for item in scanJsonFiles(full_path, prune, "%s%s/" % (prefix, name)):
+            yield item
+
 class ActionModule(ActionBase):
     
     def getLocalDashboardList(self):
-        path = self.path
-        # all_json_files = [y for x in os.walk(path) for y in glob(os.path.join(x[0], '*.json'))]
-        paths = []
-        for x in os.walk(path):
-            for y in glob(os.path.join(x[0], '*.json')):
-                if not y.startswith(self.mapping_dir):
-                    paths.append(re.sub('^' + path + '/?', '', y))
-        return paths
+        """relative paths of the dashboard files with their stat, the mapping dir is not scanned"""
+        if not os.path.isdir(self.path):
+            return OrderedDict()
+        return OrderedDict(scanJsonFiles(self.path, prune=(os.path.normpath(self.mapping_dir),)))
         
     def readFile(self, file_path):
         if os.path.exists(file_path):
             try:
-                with open(file_path) as json_data:
-                    return json.load(json_data)
+                with open(file_path, 'rb') as json_data:
+                    return jsonLoads(json_data.read())
             except Exception as e:
-                raise AnsibleError("Invalid dashboard JSON file at %s: %s" % (file_path, e.message))
+                raise AnsibleError("Invalid dashboard JSON file at %s: %s" % (file_path, e))
         return None
     
     def uuidGen(self):
@@ -46,31 +180,222 @@ class ActionModule(ActionBase):
             pass
         return True, self.uuidGen()
     
-    def getLocalDashboards(self):
-        # slug can be imported only in a module #27748
-        local_dashboards_titles = []
+    def treeCacheDir(self):
+        """a temporary directory only the current user can access, None if it can't be had"""
+        cache_dir = os.path.join(tempfile.gettempdir(), "ansible-grafana-dashboards-%d" % os.getuid())
+        try:
+            os.mkdir(cache_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return None
+        try:
+            st = os.lstat(cache_dir)
+        except OSError:
+            return None
+        # the name is predictable, another user may have created it first
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            return None
+        return cache_dir
+    
+    def treeCachePath(self):
+        """tasks run in workers forked from ansible-playbook, so the cache file is named after its pid"""
+        cache_dir = self.treeCacheDir()
+        if cache_dir is None:
+            return None
+        key = hashlib.sha1(("%s|%s" % (self.path, self.mapping_dir)).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(cache_dir, "%d-%s.json" % (os.getppid(), key))
+    
+    def treeFingerprint(self):
+        fingerprint = hashlib.sha1()
+        for dash_path in sorted(self.local_dashboards_paths):
+            st = self.local_dashboards_paths[dash_path]
+            fingerprint.update(("%s:%r:%d\n" % (dash_path, st.st_mtime, st.st_size)).encode('utf-8'))
+        return fingerprint.hexdigest()
+    
+    def loadTreeCache(self):
+        cache_path = self.treeCachePath()
+        if cache_path is None:
+            return None
+        cached = _TREE_CACHE.get(cache_path)
+        if not cached or cached["fingerprint"] != self.tree_fingerprint:
+            try:
+                with open(cache_path, 'rb') as cache_file:
+                    if os.fstat(cache_file.fileno()).st_uid != os.getuid():
+                        return None
+                    cached = jsonLoads(cache_file.read())
+            except (IOError, OSError, ValueError):
+                return None
+        if cached.get("fingerprint") != self.tree_fingerprint:
+            return None
+        _TREE_CACHE[cache_path] = cached
+        return copy.deepcopy(cached)
+    
+    def storeTreeCache(self):
+        """caches the parsed tree and slugs for the next hosts of the play, unless they are cached already"""
+        if self.tree_cache["hit"] and not self.new_slugs:
+            return
+        cache_path = self.treeCachePath()
+        if cache_path is None:
+            return
+        # bodies are left out, the next hosts read them from the files when they are needed (see fullDashboard)
+        dashboards = []
+        for dash in self.local_dashboard_list:
+            if not dash.get("partial"):
+                dash = {"dashboard": dict((k, dash["dashboard"][k]) for k in ["id", "title", "version"] if k in dash["dashboard"]), "path": dash["path"], "partial": True}
+            dashboards.append(dash)
+        cached = {
+            "fingerprint": self.tree_fingerprint,
+            "parse_time": self.parse_time,
+            "dashboards": dashboards,
+            "slugged": self.slugged,
+        }
+        _TREE_CACHE[cache_path] = copy.deepcopy(cached)
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, "w") as outfile:
+            outfile.write(jsonDumps(cached))
+        os.rename(tmpfile, cache_path)
+        self.removeStaleTreeCaches(os.path.dirname(cache_path))
+    
+    def removeStaleTreeCaches(self, cache_dir):
+        for cache_path in glob(os.path.join(cache_dir, "*-*.json")):
+            try:
+                os.kill(int(os.path.basename(cache_path).split("-")[0]), 0)
+            except ValueError:
+                continue
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    try:
+                        os.remove(cache_path)
+                    except OSError:
+                        pass
+    
+    def readLocalDashboards(self):
+        started = time.time()
+        self.tree_fingerprint = self.treeFingerprint()
+        cached = self.loadTreeCache()
+        if cached:
+            self.local_dashboard_list = cached["dashboards"]
+            self.cached_slugs = cached["slugged"]
+            self.parse_time = cached["parse_time"]
+            self.tree_cache = {"hit": True, "time_saved": round(max(0, self.parse_time - (time.time() - started)), 3)}
+            return
+        self.readIndex()
+        stale = []
+        for dash_path in self.local_dashboards_paths:
+            st = self.local_dashboards_paths[dash_path]
+            entry = self.saved_index.get(self.indexKey(dash_path))
+            if not entry or entry["mtime"] != st.st_mtime or entry["size"] != st.st_size:
+                stale.append((self.path, dash_path, st.st_mtime, st.st_size, entry))
+            else:
+                self.index_stats["unchanged"] += 1
+        parsed = self.indexDashboards(stale)
         local_dashboard_list = []
+        for dash_path in self.local_dashboards_paths:
+            key = self.indexKey(dash_path)
+            dash = None
+            if dash_path in parsed:
+                self.index[key], dash = parsed[dash_path]
+            else:
+                # a copy, saveIndex compares the index with the saved one
+                self.index[key] = dict(self.saved_index[key])
+            entry = self.index[key]
+            if dash is not None:
+                local_dashboard_list.append({"dashboard": dash, "path": dash_path})
+            else:
+                # the body is only read if the dashboard has to be uploaded or rewritten, see fullDashboard
+                header = dict((k, entry[k]) for k in ["id", "title", "version"] if k in entry)
+                local_dashboard_list.append({"dashboard": header, "path": dash_path, "partial": True})
+        self.local_dashboard_list = local_dashboard_list
+        self.cached_slugs = dict((entry["title"], entry["slug"]) for entry in self.index.values() if "slug" in entry)
+        self.parse_time = time.time() - started
+        self.tree_cache = {"hit": False, "time_saved": 0}
+    
+    def indexKey(self, dash_path):
+        """index entries are relative to the root path, so shards share one index"""
+        return os.path.relpath("%s/%s" % (self.path, dash_path), self.root_path)
+    
+    def readIndex(self):
+        self.index_path = "%s/index.json" % self.mapping_dir
+        self.saved_index = self.readFile(self.index_path) or {}
+        # entries of this run's files only, the ones of deleted or renamed files are dropped by saveIndex
+        self.index = {}
+        self.index_stats = {"unchanged": 0, "rehashed": 0, "header_only": 0, "parsed": 0}
+    
+    def indexDashboards(self, stale):
+        """indexes new and modified files, in a process pool of `parse_workers` when there are enough of them
+        
+        returns {path: (index entry, parsed dashboard or None)}, pooled workers only send back the index entries
+        """
+        workers = self.parse_workers or multiprocessing.cpu_count()
+        pool = None
+        if workers > 1 and len(stale) >= PARSE_POOL_MIN_FILES:
+            try:
+                pool = parsePool(min(workers, len(stale)))
+            except (AssertionError, OSError, ValueError):
+                # daemonic ansible workers can't have children, parse serially
+                pool = None
+        if pool:
+            try:
+                results = pool.map(indexDashboardFile, [job + (False,) for job in stale], max(1, len(stale) // (workers * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            workers = 1
+            results = []
+            for job in stale:
+                results.append(indexDashboardFile(job + (True,)))
+                if results[-1][2]:
+                    break
+        self.index_stats["parse_workers"] = workers
+        parsed = {}
+        for job, (entry, dash, error) in zip(stale, results):
+            if error:
+                raise AnsibleError(error)
+            old_entry = job[4]
+            if old_entry and old_entry["hash"] == entry["hash"]:
+                self.index_stats["rehashed"] += 1
+            else:
+                self.index_stats["header_only" if entry.pop("header_only", False) else "parsed"] += 1
+            parsed[job[1]] = (entry, dash)
+        return parsed
+    
+    def saveIndex(self):
+        """adds slugs to the index and writes it, entries of other shards are kept"""
+        if self.index is None:
+            return
+        for entry in self.index.values():
+            if entry["title"] in self.slugged:
+                entry["slug"] = self.slugged[entry["title"]]
+        scope = os.path.relpath(self.path, self.root_path)
+        def in_scope(key):
+            return scope == "." or key.startswith(scope + os.sep)
+        index = dict((k, v) for k, v in self.saved_index.items() if not in_scope(k))
+        index.update(self.index)
+        if index != self.saved_index:
+            self.saveJson(index, self.index_path)
+    
+    def fullDashboard(self, dash):
+        """loads the body of a dashboard read from the index, the UUID set meanwhile is kept"""
+        if dash.pop("partial", False):
+            started = time.time()
+            body = self.readFile("%s/%s" % (self.path, dash["path"]))
+            body["id"] = dash["dashboard"]["id"]
+            dash["dashboard"] = body
+            self.timePhase("full_parse", started)
+        return dash["dashboard"]
+    
+    def timePhase(self, phase, started):
+        self.timings[phase] = round(self.timings.get(phase, 0) + time.time() - started, 3)
+    
+    def getLocalDashboards(self):
+        # slug can be imported only in a module #27748, titles are slugged by getRemoteDashboards
         local_dashboards = {}
         local_dashboards_uuids = {}
         
-        for dash_path in self.local_dashboards_paths:
-            dash = self.readFile("%s/%s" % (self.path,dash_path))
-            if not dash or "id" not in dash or "title" not in dash:
-                raise AnsibleError("Invalid dashboard %s" % dash_path)
-
-
-            local_dashboards_titles.append(dash["title"])
-            local_dashboard_list.append({"dashboard": dash, "path": dash_path})
-        
-        self.args["action"] = "slug"
-        self.args["action_args"] = json.dumps(local_dashboards_titles)
-        slug_result = self._execute_module(module_args=self.args, task_vars=self.task_vars)
-        if "failed" in slug_result and slug_result["failed"]:
-            raise AnsibleError("Slug failed: %s" % slug_result["msg"])
-        # raise AnsibleError("slugged = %s" % slug_result["slugged"])
-        for dash in local_dashboard_list:
-            # raise AnsibleError("dash: %s" % slug_result["slugged"][dash["dashboard"]["title"]])
-            dash["slug"] = slug_result["slugged"][dash["dashboard"]["title"]]
+        for dash in self.local_dashboard_list:
+            # raise AnsibleError("dash: %s" % self.slugged[dash["dashboard"]["title"]])
+            dash["slug"] = self.slugged[dash["dashboard"]["title"]]
             if dash["slug"] in local_dashboards:
                 raise AnsibleError("Duplicate dashboard %s, %s" % (local_dashboards[dash["slug"]]["path"], dash["path"]))
             if dash["dashboard"]["id"] in local_dashboards_uuids:
@@ -81,41 +406,357 @@ class ActionModule(ActionBase):
                 self.uuided_dashboard_slugs.append(dash["slug"])
             local_dashboards[dash["slug"]] = dash
         self.local_dashboards = local_dashboards
+        self.local_slug_by_uuid = {}
+        for slug in local_dashboards:
+            self.local_slug_by_uuid.setdefault(local_dashboards[slug]["dashboard"]["id"], slug)
         self.saveDashboardUUIDs()
     
     def saveDashboardUUIDs(self):
         for slug in self.uuided_dashboard_slugs:
-            self.saveJson(self.local_dashboards[slug]['dashboard'], "%s/%s" % (self.path, self.local_dashboards[slug]["path"]))
+            self.saveJson(self.fullDashboard(self.local_dashboards[slug]), "%s/%s" % (self.path, self.local_dashboards[slug]["path"]))
             self.uuided_dashboards.append(self.local_dashboards[slug]["path"])
             self.changed = True
     
-    def getRemoteDashboards(self):
-        self.args["action"] = "get_dashboards"
-        self.args["action_args"] = "{}"
+    def runModule(self, action_args, description):
+        """runs the module's combined sync action, so a whole phase costs one module launch"""
+        self.args["action"] = "sync"
+        self.args["action_args"] = jsonDumps(action_args)
         run_result = self._execute_module(module_args=self.args, task_vars=self.task_vars)
         if "failed" in run_result and run_result["failed"]:
             if run_result["msg"] == "MODULE FAILURE":
-                raise AnsibleError("Getting remote dashboards failed: %s" % run_result)
+                raise AnsibleError("%s failed: %s" % (description, run_result))
             else:
-                raise AnsibleError("Getting remote dashboards failed: %s" % run_result["msg"])
-        self.remote_dashboards = run_result["dashboards"]
+                raise AnsibleError("%s failed: %s" % (description, run_result["msg"]))
+        return run_result
+    
+    def runInstances(self, action_args, instances_args, description):
+        """runs a sync phase against all instances in one module run, returns the module result and the results by instance"""
+        if self.multi_instance:
+            run_result = self.runModule(dict(action_args, instances=instances_args), description)
+            return run_result, run_result.get("instances", {})
+        results = {}
+        run_result = {}
+        for name in instances_args:
+            run_result = self.runModule(dict(action_args, **instances_args[name]), description)
+            results[name] = run_result
+        return run_result, results
+    
+    def newInstanceState(self):
+        return {
+            "remote_dashboards": {},
+            "missing_ids": set(),
+            "dashboard_slugs_to_upload": [],
+            "dashboard_slugs_to_download": [],
+            "local_dashboard_slugs_to_delete": [],
+            "remote_dashboard_slugs_to_delete": [],
+            "downloaded_dashboards": [],
+            "uploaded_dashboards": [],
+            "dashboards_upload": {},
+            "http_stats": {},
+            "fetch_stats": {},
+            "upload_stats": {},
+            "remote_delete_results": {},
+            "remote_delete_failures": {},
+            "upload_failures": {},
+            "out_of_shard_dashboards": [],
+            "unlisted_dashboards": [],
+            "instance_error": None,
+        }
+    
+    def switchInstance(self, name):
+        """swaps in the state of another instance, the local tree and mappings are shared by all of them"""
+        if self.instance_name is not None:
+            self.instance_states[self.instance_name] = dict((k, getattr(self, k)) for k in self.newInstanceState())
+        self.instance_name = name
+        state = self.instance_states.get(name) or self.newInstanceState()
+        for k in state:
+            setattr(self, k, state[k])
+    
+    def knownRemoteVersions(self):
+        known_versions = {}
+        for u in self.mappings:
+            if self.instance_name in self.mappings[u]["instances"]:
+                m = self.mappings[u]["instances"][self.instance_name]
+                known_versions[str(m["id"])] = m["version"]
+        return known_versions
+    
+    def getRemoteDashboards(self):
+        titles = [dash["dashboard"]["title"] for dash in self.local_dashboard_list if dash["dashboard"]["title"] not in self.cached_slugs]
+        instances_args = {}
+        for name in self.instance_names:
+            self.switchInstance(name)
+            action_args = {"get_dashboards": True}
+            if self.incremental:
+                action_args["known_versions"] = self.knownRemoteVersions()
+            # mapped dashboards that aren't listed are looked up by id before their files are deleted
+            mappings = [self.getMappingForLocalDahsboardID(dash["dashboard"]["id"]) for dash in self.local_dashboard_list]
+            action_args["check_ids"] = [m["id"] for m in mappings if m]
+            instances_args[name] = action_args
+        run_result, results = self.runInstances({"slug": titles}, instances_args, "Getting remote dashboards")
+        self.new_slugs = run_result["slugged"]
+        self.target_json_backend = run_result.get("json_backend")
+        self.slugged = dict(self.cached_slugs)
+        self.slugged.update(self.new_slugs)
+        for name in self.instance_names:
+            self.switchInstance(name)
+            run_result = results.get(name, {})
+            if run_result.get("failed"):
+                self.instance_error = "Getting remote dashboards failed: %s" % run_result.get("msg")
+                continue
+            # None when grafana can't look dashboards up by id
+            missing_ids = run_result.get("missing_ids", [])
+            self.missing_ids = set(missing_ids) if missing_ids is not None else None
+            self.remote_dashboards = run_result["dashboards"]
+            for slug in self.remote_dashboards:
+                dash = self.remote_dashboards[slug]
+                if dash.pop("unchanged", False):
+                    # only the version was checked, the rest of the mapping info is still valid
+                    _, mapping = self.getMappingForRemoteDahsboardID(dash["id"])
+                    dash["updated"] = mapping["updated"]
+            self.http_stats["fetch"] = run_result.get("http_stats")
+            self.fetch_stats = run_result.get("fetch_stats")
     
     def readMappings(self):
         mappings = self.readFile(self.mapping_file_path)
         if not mappings:
             mappings = {}
+        # entries of the sharded layout keep their instances in instances/<name>.json
+        stored_sharded = os.path.isdir(self.shard_dir) and not any("instances" in m for m in mappings.values())
+        if stored_sharded:
+            mappings = self.joinMappingShards(mappings, self.instance_names if self.mapping_layout == "sharded" else self.storedShardNames())
+        self.migrate_mappings = stored_sharded != (self.mapping_layout == "sharded")
+        self.foreign_bumps = {}
         self.mappings = mappings
+        self.replayMappingsJournal()
+        self.indexMappings()
     
-    def saveMappings(self):
-        if not self.check_mode:
-            self.saveJson(self.mappings, self.mapping_file_path)
+    def shardPath(self, name):
+        return "%s/%s.json" % (self.shard_dir, name.replace(os.sep, "_"))
+    
+    def storedShardNames(self):
+        return [file_name[:-5] for file_name in sorted(os.listdir(self.shard_dir)) if file_name.endswith(".json")]
+    
+    def joinMappingShards(self, shared, names):
+        """mappings of the shared file with the instances of `names`, entries mapped to none of them are kept only when other shards weren't read"""
+        mappings = dict((dash_uuid, dict(shared[dash_uuid], instances={})) for dash_uuid in shared)
+        for name in names:
+            for dash_uuid, info in (self.readFile(self.shardPath(name)) or {}).items():
+                # a shard entry without a shared one gets its slug back from the next download
+                mappings.setdefault(dash_uuid, {"slug": None, "updated": None, "instances": {}})["instances"][name] = info
+        if self.mapping_layout != "sharded":
+            mappings = dict((dash_uuid, m) for dash_uuid, m in mappings.items() if m["instances"])
+        return mappings
+    
+    def indexMappings(self):
+        """(instance, remote id) -> UUID, remote dashboards are looked up without scanning the mappings"""
+        self.remote_id_index = {}
+        self.remote_id_keys = {}
+        for dash_uuid in self.mappings:
+            self.reindexMapping(dash_uuid)
+    
+    def reindexMapping(self, dash_uuid):
+        """follows a changed, added or removed mapping entry"""
+        for key in self.remote_id_keys.pop(dash_uuid, ()):
+            if self.remote_id_index.get(key) == dash_uuid:
+                del self.remote_id_index[key]
+        if dash_uuid in self.mappings:
+            keys = [(name, info["id"]) for name, info in self.mappings[dash_uuid]["instances"].items()]
+            for key in keys:
+                # the first entry wins, like the scan did
+                self.remote_id_index.setdefault(key, dash_uuid)
+            self.remote_id_keys[dash_uuid] = keys
+    
+    def mappingsJournalPath(self):
+        """shards (and instances with the sharded layout) have their own journal, they may run at the same time"""
+        if not self.sharded and self.mapping_layout != "sharded":
+            return "%s/mappings.journal" % self.mapping_dir
+        instances = sorted(self.instance_names) if self.mapping_layout == "sharded" else []
+        key = hashlib.sha1(("%s|%s|%s|%s" % (self.path, self.args.get("folder_id"), sorted(self.args.get("tags") or []), instances)).encode('utf-8')).hexdigest()[:12]
+        return "%s/mappings-%s.journal" % (self.mapping_dir, key)
+    
+    def replayMappingsJournal(self):
+        """applies the changes of a run that was interrupted before commitMappings"""
+        self.journal_path = self.mappingsJournalPath()
+        self.journal = None
+        self.recovered_mappings = 0
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as journal:
+            for line in journal:
+                try:
+                    changes = jsonLoads(line)
+                except ValueError:
+                    # the last line may have been cut short
+                    break
+                if isinstance(changes, list):
+                    # ["bump", uuid], see updateMappingForRemoteDashboardIfRequired
+                    self.bumpForeignShards(changes[1])
+                    continue
+                for dash_uuid in changes:
+                    if changes[dash_uuid] is None:
+                        self.mappings.pop(dash_uuid, None)
+                    else:
+                        self.mappings[dash_uuid] = changes[dash_uuid]
+                    self.changed_mapping_uuids.add(dash_uuid)
+                self.recovered_mappings += len(changes)
+        if self.recovered_mappings:
+            self.changed = True
+    
+    def saveMappings(self, dash_uuids):
+        """changed entries are journaled and written to the mappings file once by commitMappings, every change to self.mappings goes through here"""
+        self.changed_mapping_uuids.update(dash_uuids)
+        for dash_uuid in dash_uuids:
+            self.reindexMapping(dash_uuid)
+        if self.check_mode:
+            return
+        self.journalMappings(dict((dash_uuid, self.mappings.get(dash_uuid)) for dash_uuid in dash_uuids))
+    
+    def journalMappings(self, changes):
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a')
+        self.journal.write(jsonDumps(changes) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+    
+    def bumpForeignShards(self, dash_uuid):
+        """a download raises the version of the other instances' mappings, the ones whose shard this run doesn't read are bumped on commit"""
+        if self.mapping_layout == "sharded":
+            self.foreign_bumps[dash_uuid] = self.foreign_bumps.get(dash_uuid, 0) + 1
+            self.changed_mapping_uuids.add(dash_uuid)
+    
+    def commitMappings(self):
+        """a sharded run writes back only the entries it changed, so shards of an instance can be synced side by side"""
+        dash_uuids = self.changed_mapping_uuids
+        if (dash_uuids or self.migrate_mappings) and not self.check_mode:
+            if self.migrate_mappings:
+                self.changed = True
+            mappings = self.mappings
+            bumped_shards = {}
+            if self.mapping_layout == "sharded":
+                mappings, bumped_shards = self.commitMappingShards(dash_uuids)
+            elif self.sharded and not self.migrate_mappings:
+                mappings = self.readFile(self.mapping_file_path) or {}
+                for dash_uuid in dash_uuids:
+                    if dash_uuid in self.mappings:
+                        mappings[dash_uuid] = self.mappings[dash_uuid]
+                    else:
+                        mappings.pop(dash_uuid, None)
+            self.saveJson(mappings, self.mapping_file_path)
+            if self.migrate_mappings and self.mapping_layout != "sharded":
+                # back from the sharded layout, all shards were read and are in the file now
+                for name in self.storedShardNames():
+                    os.remove(self.shardPath(name))
+                os.rmdir(self.shard_dir)
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            # bumps are relative, the journal is gone before they are written so a replay can't apply them twice
+            for name in bumped_shards:
+                self.saveJson(bumped_shards[name], self.shardPath(name))
+    
+    def commitMappingShards(self, dash_uuids):
+        """writes the shards of this run's instances, returns the shared part of the mappings and the bumped shards of other instances
+        
+        entries are merged into the files on disk, other instances (and shards of
+        this one) may have written them since they were read
+        """
+        if self.migrate_mappings:
+            # the first run with the sharded layout splits the whole file
+            dash_uuids = set(self.mappings)
+            names = sorted(set(name for m in self.mappings.values() for name in m["instances"]) | set(self.instance_names))
+            shared = {}
+            shards = dict((name, {}) for name in names)
+        else:
+            names = self.instance_names
+            shared = self.readFile(self.mapping_file_path) or {}
+            shards = dict((name, self.readFile(self.shardPath(name)) or {}) for name in names)
+        other_shards = None
+        bumped_shards = {}
+        for dash_uuid in dash_uuids:
+            m = self.mappings.get(dash_uuid)
+            for name in names:
+                if m and name in m["instances"]:
+                    shards[name][dash_uuid] = m["instances"][name]
+                else:
+                    shards[name].pop(dash_uuid, None)
+            if m:
+                shared[dash_uuid] = {"slug": m["slug"], "updated": m["updated"]}
+                continue
+            if other_shards is None:
+                other_shards = self.otherShards(names)
+            if not any(dash_uuid in shard for shard in other_shards.values()):
+                shared.pop(dash_uuid, None)
+        if self.foreign_bumps and not self.migrate_mappings:
+            if other_shards is None:
+                other_shards = self.otherShards(names)
+            for name in other_shards:
+                bumped = [dash_uuid for dash_uuid in self.foreign_bumps if dash_uuid in other_shards[name]]
+                for dash_uuid in bumped:
+                    other_shards[name][dash_uuid]["version"] += self.foreign_bumps[dash_uuid]
+                if bumped:
+                    bumped_shards[name] = other_shards[name]
+        if not os.path.isdir(self.shard_dir):
+            os.makedirs(self.shard_dir)
+        for name in shards:
+            self.saveJson(shards[name], self.shardPath(name))
+        return shared, bumped_shards
+    
+    def otherShards(self, names):
+        """shards of the instances this run doesn't sync"""
+        if not os.path.isdir(self.shard_dir):
+            return {}
+        return dict((name, self.readFile(self.shardPath(name)) or {}) for name in self.storedShardNames() if name not in names)
     
     def saveJson(self, content, file_path):
+        """files whose content would not change are not rewritten"""
+        # stays on the stdlib encoder: ujson formats small floats differently (1e-7 vs 1e-07) and orjson can't indent by 4
         if not self.check_mode:
-            _, tmpfile = tempfile.mkstemp()
-            with open(tmpfile, "w") as outfile:
-                json.dump(content, outfile, sort_keys=True, indent=4, separators=(',', ': '))
-            self.move_file(tmpfile, file_path)
+            data = json.dumps(content, sort_keys=True, indent=4, separators=(',', ': ')).encode('utf-8')
+            if self.sameContent(file_path, data):
+                self.write_stats["skipped"] += 1
+                return
+            # the temp file is renamed within its directory and synced first, so a crash
+            # leaves either the old or the new content, which the journal relies on
+            dir_path = os.path.dirname(file_path) or "."
+            fd, tmpfile = tempfile.mkstemp(dir=dir_path, prefix=".%s." % os.path.basename(file_path))
+            try:
+                with os.fdopen(fd, "wb") as outfile:
+                    outfile.write(data)
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+                self.move_file(tmpfile, file_path)
+            except Exception:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+                raise
+            self.syncDir(dir_path)
+            self.write_stats["written"] += 1
+    
+    def syncDir(self, dir_path):
+        """makes renames in `dir_path` durable"""
+        try:
+            fd = os.open(dir_path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            # not supported for directories on every platform
+            pass
+        finally:
+            os.close(fd)
+    
+    def sameContent(self, file_path, data):
+        """files of a different size are not read, a skipped file also keeps its mtime and so its index entry"""
+        try:
+            if os.path.getsize(file_path) != len(data):
+                return False
+            with open(file_path, "rb") as current:
+                return current.read() == data
+        except (IOError, OSError):
+            return False
         
     def move_file(self, src, dst):
         """should use atomic_move but didn't find a way to call it in action plugin"""
@@ -151,7 +792,7 @@ class ActionModule(ActionBase):
         else:
             return
         self.changed = True
-        self.saveMappings()
+        self.saveMappings([dash_uuid])
     
     def updateMappingForRemoteDashboardIfRequired(self, slug, limit = 1):
         if limit < 0:
@@ -173,6 +814,10 @@ class ActionModule(ActionBase):
             elif remote_info["version"] > local_info["version"]:
                 for i in self.mappings[local_uuid]["instances"]:
                     self.mappings[local_uuid]["instances"][i]["version"] += 1
+                if self.mapping_layout == "sharded":
+                    self.bumpForeignShards(local_uuid)
+                    if not self.check_mode:
+                        self.journalMappings(["bump", local_uuid])
 
             self.mappings[local_uuid]["instances"][self.instance_name] = self.mappingInfoUnflat(remote_info)["instances"][self.instance_name]
             self.mappings[local_uuid]["updated"] = remote_info["updated"]
@@ -181,27 +826,30 @@ class ActionModule(ActionBase):
                 raise AnsibleError("uuid not found for %s" % slug)
 
         if mapping_changed:
-            self.saveMappings()
+            self.saveMappings([local_uuid])
             self.changed = True            
     
     def mapPostResults(self, post_results):
         """
         {"mydashboard": {"updated": "2017-08-10T08:08:25Z", "version": 23, "id": 7, "slug": "mydashboard"}
         """
-        mapping_changed = False
+        changed_uuids = []
         for slug in post_results:
             remote_info = self.mappingInfoFromRemoteDashboard(post_results[slug])
             local_uuid, local_info = self.getMappingForRemoteDahsboardID(post_results[slug]["id"])
             if remote_info != local_info:
-                mapping_changed = True
                 if not local_uuid:
                     local_uuid = self.local_dashboards[slug]["dashboard"]["id"]
+                if local_uuid not in self.mappings:
                     self.mappings[local_uuid] = self.mappingInfoUnflat(remote_info)
                 else:
+                    # the dashboard may already be mapped to other instances
                     self.mappings[local_uuid]["instances"][self.instance_name] = self.mappingInfoUnflat(remote_info)["instances"][self.instance_name]
+                # the index has to follow before the next post result is looked up
+                self.saveMappings([local_uuid])
+                changed_uuids.append(local_uuid)
 
-        if mapping_changed:
-            self.saveMappings()
+        if changed_uuids:
             self.changed = True
     
     def flatMapping(self, m):
@@ -221,11 +869,10 @@ class ActionModule(ActionBase):
         return self.flatMapping(m)
     
     def getMappingForRemoteDahsboardID(self, dash_id):
-        for u in self.mappings:
-            if self.instance_name in self.mappings[u]["instances"]:
-                if self.mappings[u]["instances"][self.instance_name]["id"] == dash_id:
-                    return u, self.flatMapping(self.mappings[u])
-        return None, None
+        u = self.remote_id_index.get((self.instance_name, dash_id))
+        if u is None:
+            return None, None
+        return u, self.flatMapping(self.mappings[u])
     
     def removeDashboardFromMapping(self,dash_uuid):
         mapping_changed = False
@@ -237,9 +884,19 @@ class ActionModule(ActionBase):
                 self.mappings.pop(dash_uuid, '')
                 mapping_changed = True
         if mapping_changed:
-            self.saveMappings()
+            self.saveMappings([dash_uuid])
             self.changed = True    
     
+    def localUUIDsOutsideShard(self):
+        """UUIDs of the dashboards kept in path but outside of the shard's subdirectory"""
+        if self.outside_uuids is None:
+            self.outside_uuids = set()
+            for dash_path, _ in scanJsonFiles(self.root_path, prune=(os.path.normpath(self.path), os.path.normpath(self.mapping_dir))):
+                dash = self.readFile("%s/%s" % (self.root_path, dash_path))
+                if isinstance(dash, dict) and "id" in dash:
+                    self.outside_uuids.add(dash["id"])
+        return self.outside_uuids
+    
     def compareDashboards(self):
         dashboard_slugs_to_upload = []
         dashboard_slugs_to_download = []
@@ -291,9 +948,21 @@ class ActionModule(ActionBase):
             if "local" not in mapped_dashboard_slugs[local_uuid] and "remote" not in mapped_dashboard_slugs[local_uuid]:
                 raise AnsibleError("Invalid mapped_dashboard_slugs dictionary: %s" % mapped_dashboard_slugs)
             elif "local" not in mapped_dashboard_slugs[local_uuid]:
-                remote_dashboard_slugs_to_delete.append(mapped_dashboard_slugs[local_uuid]["remote"])
+                if self.sharded and local_uuid in self.localUUIDsOutsideShard():
+                    self.out_of_shard_dashboards.append(mapped_dashboard_slugs[local_uuid]["remote"])
+                else:
+                    remote_dashboard_slugs_to_delete.append(mapped_dashboard_slugs[local_uuid]["remote"])
             elif "remote" not in mapped_dashboard_slugs[local_uuid]:
-                local_dashboard_slugs_to_delete.append(mapped_dashboard_slugs[local_uuid]["local"])
+                remote_id = self.getMappingForLocalDahsboardID(local_uuid)["id"]
+                # a shard only lists its own folder/tags, the dashboard may have just left them
+                if self.sharded and remote_id not in (self.missing_ids or ()):
+                    self.out_of_shard_dashboards.append(mapped_dashboard_slugs[local_uuid]["local"])
+                # api/search pages aren't a snapshot, a dashboard deleted or renamed while they
+                # were listed shifts the later pages and another one is skipped
+                elif not self.sharded and self.missing_ids is not None and remote_id not in self.missing_ids:
+                    self.unlisted_dashboards.append(mapped_dashboard_slugs[local_uuid]["local"])
+                else:
+                    local_dashboard_slugs_to_delete.append(mapped_dashboard_slugs[local_uuid]["local"])
             else:
                 rdash = self.remote_dashboards[mapped_dashboard_slugs[local_uuid]["remote"]]
                 lmapping = self.getMappingForLocalDahsboardID(local_uuid)
@@ -313,12 +982,18 @@ class ActionModule(ActionBase):
         self.remote_dashboard_slugs_to_delete = remote_dashboard_slugs_to_delete
         # raise AnsibleError("Delete list: %s" % self.local_dashboard_slugs_to_delete)        
     
+    def slugPath(self, slug, path=""):
+        """file name for a slug, a shard's dashboards stay in the subdirectory they were found in"""
+        if not self.sharded:
+            return "%s.json" % slug
+        return os.path.join(os.path.dirname(path), "%s.json" % slug)
+    
     def fixLocalDahsboardsNames(self):
         for slug in self.local_dashboards:
-            if self.local_dashboards[slug]["path"] != slug + '.json':
-                src, dst = self.local_dashboards[slug]["path"], "%s.json" % slug
+            src, dst = self.local_dashboards[slug]["path"], self.slugPath(slug, self.local_dashboards[slug]["path"])
+            if src != dst:
                 self.setLocaldashboardName(src, dst)
-                self.local_dashboards[slug]["path"] = slug + '.json'
+                self.local_dashboards[slug]["path"] = dst
     
     def setLocaldashboardName(self, src, dst):
         self.move_file("%s/%s" % (self.path, src), "%s/%s" % (self.path, dst))
@@ -326,15 +1001,25 @@ class ActionModule(ActionBase):
         self.changed = True    
     
     def localDashboardSlugByUUID(self, dash_uuid):
-        for dash in self.local_dashboards:
-            if self.local_dashboards[dash]["dashboard"]["id"] == dash_uuid:
-                return dash
-        return None    
+        return self.local_slug_by_uuid.get(dash_uuid)
+    
+    def setLocalDashboard(self, slug, dash):
+        """adds or replaces a local dashboard, keeping local_slug_by_uuid in step"""
+        if slug in self.local_dashboards:
+            self.popLocalDashboard(slug)
+        self.local_dashboards[slug] = dash
+        self.local_slug_by_uuid[dash["dashboard"]["id"]] = slug
+    
+    def popLocalDashboard(self, slug):
+        dash = self.local_dashboards.pop(slug)
+        if self.local_slug_by_uuid.get(dash["dashboard"]["id"]) == slug:
+            del self.local_slug_by_uuid[dash["dashboard"]["id"]]
+        return dash
     
     def saveRemoteDashboards(self):
         for slug in self.dashboard_slugs_to_download:
             self.updateMappingForRemoteDashboardIfRequired(slug)
-            dst = "%s.json" % slug
+            dst = self.slugPath(slug)
             local_uuid, mapping = self.getMappingForRemoteDahsboardID(self.remote_dashboards[slug]['id'])
             if local_uuid == None:
                 raise AnsibleError("No UUID for %s" % self.remote_dashboards[slug]["dashboard"]["id"])
@@ -342,11 +1027,16 @@ class ActionModule(ActionBase):
             if lslug != None:
                 ldash_path = self.local_dashboards[lslug]["path"]
                 src = ldash_path
+                dst = self.slugPath(slug, ldash_path)
                 if src != dst:
                     self.setLocaldashboardName(src, dst)
                     self.local_dashboards[lslug]["path"] = dst
+                if lslug != slug:
+                    self.popLocalDashboard(lslug)
             self.remote_dashboards[slug]["dashboard"]["id"] = local_uuid
             self.saveJson(self.remote_dashboards[slug]['dashboard'], "%s/%s" % (self.path, dst))
+            # other instances are compared with the downloaded version
+            self.setLocalDashboard(slug, {"dashboard": self.remote_dashboards[slug]["dashboard"], "path": dst, "slug": slug})
             self.downloaded_dashboards.append(dst)
             self.changed = True
     
@@ -357,21 +1047,17 @@ class ActionModule(ActionBase):
             path = ldash["path"]
             if not self.check_mode:
                 os.remove("%s/%s" % (self.path, path))
-            dash_uuid = self.local_dashboards[lslug]["dashboard"]["id"]
+            dash_uuid = self.popLocalDashboard(lslug)["dashboard"]["id"]
             self.removeDashboardFromMapping(dash_uuid)
     
-    def removeRemoteDashboards(self):
-        if not self.check_mode:
-            self.args["action"] = "delete_dashboards"
-            self.args["action_args"] = json.dumps(self.remote_dashboard_slugs_to_delete)
-            run_result = self._execute_module(module_args=self.args, task_vars=self.task_vars)
-            if "failed" in run_result and run_result["failed"]:
-                if run_result["msg"] == "MODULE FAILURE":
-                    raise AnsibleError("Deleting remote dashboards failed: %s" % run_result)
-                else:
-                    raise AnsibleError("Deleting remote dashboards failed: %s" % run_result["msg"])
-            # raise AnsibleError("Delete result: %s" % run_result)
-        for rslug in self.remote_dashboard_slugs_to_delete:
+    def removeRemoteDashboards(self, delete_results):
+        """drops mappings of the dashboards that were actually deleted, failures are kept for the result"""
+        self.remote_dashboard_slugs_to_delete = []
+        for rslug in delete_results:
+            if delete_results[rslug]["status"] != 200:
+                self.remote_delete_failures[rslug] = delete_results[rslug]
+                continue
+            self.remote_dashboard_slugs_to_delete.append(rslug)
             dash_uuid, _ = self.getMappingForRemoteDahsboardID(self.remote_dashboards[rslug]["id"])
             self.removeDashboardFromMapping(dash_uuid)
     
@@ -380,32 +1066,61 @@ class ActionModule(ActionBase):
         for slug in self.dashboard_slugs_to_upload:
             self.changed = True
             self.uploaded_dashboards.append(slug)
-            dashboards_upload[slug] = self.local_dashboards[slug]
+            # a copy, the remote id and version are specific to this instance
+            dashboards_upload[slug] = {"slug": slug, "path": self.local_dashboards[slug]["path"], "dashboard": dict(self.fullDashboard(self.local_dashboards[slug]))}
             mapping = self.getMappingForLocalDahsboardID(self.local_dashboards[slug]["dashboard"]["id"])
             if mapping:
                 dashboards_upload[slug]["dashboard"]["version"] = mapping["version"]
                 dashboards_upload[slug]["dashboard"]["id"] = mapping["id"]
-                
-        if not self.check_mode:
-            self.args["action"] = "upload_dashboards"
-            self.args["action_args"] = json.dumps(dashboards_upload)
-            run_result = self._execute_module(module_args=self.args, task_vars=self.task_vars)
-            if "failed" in run_result and run_result["failed"]:
-                if run_result["msg"] == "MODULE FAILURE":
-                    raise AnsibleError("Posting dashboards failed: %s" % run_result)
-                else:
-                    raise AnsibleError("Posting dashboards failed: %s" % run_result["msg"])
-            post_results = run_result["post_results"]
-            self.mapPostResults(post_results)
+        self.dashboards_upload = dashboards_upload
+    
+    def pushRemoteChanges(self):
+        """uploads and deletes remote dashboards of all instances in a single module run"""
+        instances_args = {}
+        for name in self.instance_names:
+            self.switchInstance(name)
+            if self.remote_dashboard_slugs_to_delete:
+                self.changed = True
+            if not self.check_mode and not self.instance_error and (self.dashboards_upload or self.remote_dashboard_slugs_to_delete):
+                instances_args[name] = {"upload_dashboards": self.dashboards_upload, "delete_dashboards": self.remote_dashboard_slugs_to_delete}
+        results = {}
+        if instances_args:
+            _, results = self.runInstances({}, instances_args, "Pushing dashboards")
+        for name in self.instance_names:
+            self.switchInstance(name)
+            if not self.instance_error:
+                self.applyPushResult(results.get(name))
+    
+    def applyPushResult(self, run_result):
+        if self.check_mode:
+            delete_results = dict((rslug, {"status": 200}) for rslug in self.remote_dashboard_slugs_to_delete)
+        elif run_result and run_result.get("failed"):
+            self.instance_error = "Pushing dashboards failed: %s" % run_result.get("msg")
+            return
+        elif run_result:
+            self.http_stats["push"] = run_result.get("http_stats")
+            self.upload_stats = run_result.get("upload_stats", {})
+            self.upload_failures = run_result.get("upload_failures", {})
+            self.uploaded_dashboards = [slug for slug in self.uploaded_dashboards if slug not in self.upload_failures]
+            self.mapPostResults(run_result.get("post_results", {}))
+            delete_results = run_result.get("delete_results", {})
+            self.remote_delete_results = delete_results
+        else:
+            delete_results = {}
+        self.removeRemoteDashboards(delete_results)
     
     def run(self, tmp=None, task_vars=None):
         self.changed = False
         self.moved_files = []
-        self.downloaded_dashboards = []
-        self.uploaded_dashboards = []
         self.uuided_dashboards = []
-        self.local_dashboard_slugs_to_delete = []
-        self.remote_dashboard_slugs_to_delete = []
+        self.outside_uuids = None
+        self.index = None
+        self.index_stats = {}
+        self.changed_mapping_uuids = set()
+        self.instance_name = None
+        self.instance_states = {}
+        self.target_json_backend = None
+        self.write_stats = {"written": 0, "skipped": 0}
         
         self.uuided_dashboard_slugs = []
         
@@ -416,46 +1131,130 @@ class ActionModule(ActionBase):
         self.args = args
         path = re.sub('/*$', '', args['path'])
         self.path = path
+        self.root_path = path
         if "mapping_dir" not in args:
             args["mapping_dir"] = "%s/mappings" % path
         self.mapping_dir = re.sub('/*$', '', args["mapping_dir"])
+        # a shard syncs the dashboards of a grafana folder and/or tags with a subdirectory of path
+        local_subdir = args.pop("local_subdir", None)
+        if local_subdir:
+            self.path = "%s/%s" % (path, local_subdir.strip('/'))
+        self.parse_workers = int(args.pop("parse_workers", 0) or 0)
+        self.mapping_layout = args.pop("mapping_layout", None) or "single"
+        if self.mapping_layout not in ("single", "sharded"):
+            raise AnsibleError("mapping_layout must be single or sharded, got %s" % self.mapping_layout)
+        self.sharded = bool(local_subdir or args.get("folder_id") not in (None, "") or args.get("tags"))
         
         self.check_mode = task_vars["ansible_check_mode"]
         result = super(ActionModule, self).run(tmp, task_vars)
+        if not os.path.isdir(self.path) and not self.check_mode:
+            os.makedirs(self.path)
         # self._execute_module(module_args=args, task_vars=task_vars)
         
         
+        self.timings = {}
+        started = time.time()
         self.local_dashboards_paths = self.getLocalDashboardList()
+        self.timePhase("scan", started)
         
         self.mapping_file_path = "%s/mappings.json" % (self.mapping_dir)
-        self.instance_name = args["name"]
+        self.shard_dir = "%s/instances" % self.mapping_dir
+        # with `instances` the local tree is read once and synced with each of them
+        self.multi_instance = bool(args.get("instances"))
+        self.instance_names = [i["name"] for i in args["instances"]] if self.multi_instance else [args["name"]]
+        if len(set(self.instance_names)) != len(self.instance_names):
+            raise AnsibleError("Duplicate instance names: %s" % ", ".join(self.instance_names))
+        self.incremental = boolean(args.get("incremental", False), strict=False)
         
         self.readMappings()
         
-        self.getLocalDashboards()
+        started = time.time()
+        self.readLocalDashboards()
+        self.timePhase("read", started)
         
+        started = time.time()
         self.getRemoteDashboards()
+        self.timePhase("fetch", started)
+        
+        self.saveIndex()
+        
+        self.storeTreeCache()
+        
+        started = time.time()
+        self.getLocalDashboards()
 
-        self.compareDashboards()
+        # instances are compared one after another, each of them sees the downloads of the previous ones
+        for name in self.instance_names:
+            self.switchInstance(name)
+            if self.instance_error:
+                continue
 
-        self.fixLocalDahsboardsNames()
+            self.compareDashboards()
 
-        self.saveRemoteDashboards()
-        
-        self.removeLocalDashboards()
+            self.fixLocalDahsboardsNames()
+
+            self.saveRemoteDashboards()
+
+            self.removeLocalDashboards()
 
-        self.uploadDashboards()
+            self.uploadDashboards()
+        self.timePhase("compare", started)
         
-        self.removeRemoteDashboards()
+        started = time.time()
+        self.pushRemoteChanges()
+        self.timePhase("push", started)
+        
+        self.commitMappings()
 
         # result.update(self._execute_module(module_args=args, task_vars=task_vars))
         
         result["moved_files"] = self.moved_files
-        result["downloaded_dashboards"] = self.downloaded_dashboards
-        result["uploaded_dashboards"] = self.uploaded_dashboards
         result["uuided_dashboards"] = self.uuided_dashboards
-        result["local_deleted_dashboard"] = self.local_dashboard_slugs_to_delete
-        result["remote_deleted_dashboards"] = self.remote_dashboard_slugs_to_delete
+        result["tree_cache"] = self.tree_cache
+        result["index_stats"] = self.index_stats
+        result["timings"] = self.timings
+        result["write_stats"] = self.write_stats
+        result["recovered_mappings"] = self.recovered_mappings
+        result["json_backend"] = {"controller": JSON_BACKEND, "target": self.target_json_backend}
+        errors = []
+        if self.multi_instance:
+            result["instances"] = {}
+            for name in self.instance_names:
+                self.switchInstance(name)
+                result["instances"][name] = self.instanceResult()
+                errors.extend("%s: %s" % (name, e) for e in self.instanceErrors())
+        else:
+            result.update(self.instanceResult())
+            errors = self.instanceErrors()
         result["changed"] = self.changed
+        if errors:
+            result["failed"] = True
+            result["msg"] = "; ".join(errors)
         
         return result
+    
+    def instanceResult(self):
+        return {
+            "downloaded_dashboards": self.downloaded_dashboards,
+            "uploaded_dashboards": self.uploaded_dashboards,
+            "local_deleted_dashboard": self.local_dashboard_slugs_to_delete,
+            "remote_deleted_dashboards": self.remote_dashboard_slugs_to_delete,
+            "http_stats": self.http_stats,
+            "fetch_stats": self.fetch_stats,
+            "upload_stats": self.upload_stats,
+            "remote_delete_results": self.remote_delete_results,
+            "out_of_shard_dashboards": self.out_of_shard_dashboards,
+            "unlisted_dashboards": self.unlisted_dashboards,
+        }
+    
+    def instanceErrors(self):
+        errors = []
+        if self.instance_error:
+            errors.append(self.instance_error)
+        if self.upload_failures:
+            errors.append("Failed to upload dashboards: %s" % ", ".join(
+                "%s (%s)" % (slug, e) for slug, e in sorted(self.upload_failures.items())))
+        if self.remote_delete_failures:
+            errors.append("Failed to delete remote dashboards: %s" % ", ".join(
+                "%s (%s: %s)" % (rslug, r["status"], r.get("msg")) for rslug, r in sorted(self.remote_delete_failures.items())))
+        return errors
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""times compareDashboards of the action plugin on synthetic mapped trees
+
+usage: python bench/compare_mappings.py [sizes...]
+
+needs ansible installed. every dashboard is mapped, local and remote, so the
+compare looks each of them up by remote id. the time per dashboard should stay
+flat as the tree grows, the script fails when it grows more than `MAX_GROWTH`
+times from the smallest to the largest size.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "action_plugins"))
+import grafana_dashboard_sync
+
+SIZES = [1000, 2000, 5000, 10000]
+# the per-dashboard time of the largest tree may be this many times the smallest one's,
+# allows for noise and cache effects, a quadratic compare grows about as much as the tree
+MAX_GROWTH = 3
+INSTANCE = "bench"
+
+def mappedTree(size):
+    """an action plugin whose state holds `size` dashboards, mapped and equal on both sides"""
+    action = object.__new__(grafana_dashboard_sync.ActionModule)
+    action.check_mode = True
+    action.sharded = False
+    action.mapping_layout = "single"
+    action.changed = False
+    action.journal = None
+    action.changed_mapping_uuids = set()
+    action.mappings = {}
+    action.local_dashboards = {}
+    action.local_slug_by_uuid = {}
+    action.instance_name = None
+    action.instance_states = {}
+    action.switchInstance(INSTANCE)
+    for i in range(size):
+        dash_uuid = str(uuid.uuid4())
+        slug = "dash-%d" % i
+        action.mappings[dash_uuid] = {"slug": slug, "updated": "2020-01-01T00:00:00Z", "instances": {INSTANCE: {"id": i, "version": 1}}}
+        action.setLocalDashboard(slug, {"dashboard": {"id": dash_uuid, "title": slug, "version": 1}, "path": "%s.json" % slug, "slug": slug})
+        action.remote_dashboards[slug] = {"dashboard": {"id": i, "title": slug, "version": 1}, "id": i, "version": 1,
+                                          "slug": slug, "updated": "2020-01-01T00:00:00Z"}
+    action.indexMappings()
+    return action
+
+def main(sizes):
+    per_dashboard = []
+    print("%10s %10s %14s" % ("dashboards", "seconds", "us/dashboard"))
+    for size in sizes:
+        action = mappedTree(size)
+        started = time.time()
+        action.compareDashboards()
+        elapsed = time.time() - started
+        per_dashboard.append(elapsed / size)
+        print("%10d %10.3f %14.1f" % (size, elapsed, elapsed / size * 1e6))
+    growth = per_dashboard[-1] / per_dashboard[0]
+    if growth > MAX_GROWTH:
+        print("compare time per dashboard grew %.1f times, it should stay flat" % growth)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main([int(size) for size in sys.argv[1:]] or SIZES))
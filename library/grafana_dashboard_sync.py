@@ -9,13 +9,40 @@ from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
 import base64
+import email.utils
+import functools
+import io
 import re
 import shutil
-import json
+import random
+import socket
+import ssl
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.grafana_json import JSON_BACKEND, jsonDumps, jsonLoads
 from ansible.module_utils.slugify import slugify
 from ansible.module_utils.urls import fetch_url, url_argument_spec
+from ansible.module_utils.six.moves import http_client, queue
+from ansible.module_utils.six.moves.urllib.parse import urlencode, urlparse
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
+
+try:
+    import ijson
+    # the pure python backend is slower than json.loads, use_float appeared in 3.1
+    HAS_IJSON = ijson.backend != 'python' and tuple(int(v) for v in getattr(ijson, '__version__', '0').split('.')[:2]) >= (3, 1)
+except ImportError:
+    HAS_IJSON = False
+
+try:
+    # python 3 only, a SyntaxError is what older interpreters raise on it
+    from ansible.module_utils.grafana_async import AsyncGrafana, HAS_AIOHTTP
+    HAS_ASYNC = HAS_AIOHTTP
+except (ImportError, SyntaxError):
+    HAS_ASYNC = False
 
 def slug_test_pass():
     cases = [
@@ -61,55 +88,443 @@ def slug_test_pass():
             return False, "Slug test failed for '%s', expected '%s', got '%s'" % (case[0], case[1], slugged)
     return True, ""
 
+def grafanaTimestamp(http_date):
+    """converts an HTTP Date header to grafana's `updated` format, now if there is none"""
+    parsed = http_date and email.utils.parsedate_tz(http_date)
+    if parsed:
+        timestamp = email.utils.mktime_tz(parsed)
+    else:
+        timestamp = time.time()
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+def slugTitles(titles):
+    slugged = {}
+    for name in titles:
+        slugged[name] = slugify(name)
+    return slugged
+
+class GrafanaError(Exception):
+    pass
+
+class ResponseTooLarge(GrafanaError):
+    pass
+
+class StreamDecodeError(GrafanaError):
+    pass
+
+class ResponseReader:
+    """file-like response body that undoes gzip/deflate content-encoding chunk by chunk
+    and stops as soon as more than `max_size` bytes (0 is unlimited) were decoded"""
+    chunk_size = 65536
+    
+    def __init__(self, resp, on_close, encoding=None, max_size=0):
+        self.resp = resp
+        self.on_close = on_close
+        self.max_size = max_size
+        if encoding is None:
+            encoding = resp.getheader('content-encoding') or ''
+        self.encoding = encoding.lower()
+        self.decompressor = None
+        if self.encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        self.buffer = b''
+        self.eof = False
+        self.closed = False
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+    
+    def _decompress(self, chunk):
+        # a chunk may expand a lot, no more than one byte beyond max_size is decoded,
+        # the rest of the input waits in unconsumed_tail
+        limit = self.max_size - self.decoded_bytes + 1 if self.max_size else 0
+        try:
+            return self.decompressor.decompress(chunk, limit)
+        except zlib.error:
+            if self.encoding != 'deflate' or self.wire_bytes != len(chunk):
+                raise
+            # some servers send raw deflate without the zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decompressor.decompress(chunk, limit)
+    
+    def _next(self):
+        if self.decompressor and self.decompressor.unconsumed_tail:
+            # input the output limit of the last call held back
+            data = self._decompress(self.decompressor.unconsumed_tail)
+        else:
+            chunk = self.resp.read(self.chunk_size)
+            self.wire_bytes += len(chunk)
+            if not chunk:
+                self.eof = True
+                data = self.decompressor.flush() if self.decompressor else b''
+            elif self.decompressor:
+                data = self._decompress(chunk)
+            else:
+                data = chunk
+        self.decoded_bytes += len(data)
+        if self.max_size and self.decoded_bytes > self.max_size:
+            raise ResponseTooLarge("response is larger than max_response_size (%d bytes)" % self.max_size)
+        return data
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self.buffer]
+            while not self.eof:
+                chunks.append(self._next())
+            self.buffer = b''
+            return b''.join(chunks)
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while length < size and not self.eof:
+            chunks.append(self._next())
+            length += len(chunks[-1])
+        data = b''.join(chunks)
+        self.buffer = data[size:]
+        return data[:size]
+    
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.on_close(self)
+
+def proxyFor(url):
+    """the proxy fetch_url (urllib) would go through for `url`, None if there is none"""
+    parsed = urlparse(url)
+    proxy = getproxies().get(parsed.scheme)
+    if proxy and not proxy_bypass(parsed.netloc):
+        return proxy
+    return None
+
+class HTTPConnectionPool:
+    """keeps up to `size` idle keep-alive connections to the host of `baseurl`"""
+    def __init__(self, baseurl, size, timeout, validate_certs=True):
+        parsed = urlparse(baseurl)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.netloc = parsed.netloc
+        self.prefix = parsed.path.rstrip('/')
+        self.size = size
+        self.timeout = timeout
+        self.validate_certs = validate_certs
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "bytes_on_wire": 0, "bytes_decoded": 0}
+    
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+    
+    def _connect(self):
+        self._count("connections_opened")
+        if self.scheme == "https":
+            if self.validate_certs:
+                context = ssl.create_default_context()
+            else:
+                context = ssl._create_unverified_context()
+            return http_client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=context)
+        return http_client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+    
+    def _checkout(self):
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+    
+    def _checkin(self, conn):
+        if self.idle.qsize() < self.size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+    
+    def request(self, method, url, body, headers):
+        """returns (ResponseReader, info), info is shaped like fetch_url's"""
+        self._count("requests")
+        path = "%s/%s" % (self.prefix, url)
+        while True:
+            conn, reused = self._checkout()
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+            except (http_client.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # the server may have dropped an idle connection, retry on the next one
+                    continue
+                raise
+            break
+        if reused:
+            self._count("connections_reused")
+        info = dict((k.lower(), v) for k, v in resp.getheaders())
+        info.update({"status": resp.status, "msg": resp.reason, "url": "%s://%s%s" % (self.scheme, self.netloc, path)})
+        return ResponseReader(resp, functools.partial(self._release, conn, resp)), info
+    
+    def _release(self, conn, resp, reader):
+        with self.lock:
+            self.stats["bytes_on_wire"] += reader.wire_bytes
+            self.stats["bytes_decoded"] += reader.decoded_bytes
+        if reader.eof and not resp.will_close:
+            self._checkin(conn)
+        else:
+            conn.close()
+    
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class RateLimiter:
+    """token bucket of `rate` requests per second (0 is unlimited) in front of an AIMD limit
+    on requests in flight: +1 per window of successful requests, halved when grafana is overloaded"""
+    def __init__(self, rate, max_in_flight):
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.max_in_flight = max_in_flight
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.refilled = time.time()
+        self.cond = threading.Condition()
+    
+    def acquire(self):
+        with self.cond:
+            while True:
+                timeout = None
+                if self.rate > 0:
+                    now = time.time()
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                    self.refilled = now
+                    if self.tokens < 1:
+                        timeout = (1 - self.tokens) / self.rate
+                if self.in_flight < int(self.limit) and timeout is None:
+                    if self.rate > 0:
+                        self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self.cond.wait(timeout)
+    
+    def release(self, overloaded):
+        with self.cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(self.max_in_flight, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
 class Grafana:
-    def __init__(self, module, baseurl, username, password):
+    def __init__(self, module, baseurl, username, password, pool_size=0, rate_limit=0, max_in_flight=8, max_retries=0):
         self.baseurl = baseurl
         self.module=module
         self.socket_timeout = 30
         self.headers = {
             'content-type': "application/json;charset=UTF-8",
-            'authorization': "Basic %s" % base64.encodestring('%s:%s' % (username, password)).replace('\n', '')
+            'authorization': "Basic %s" % base64.b64encode(('%s:%s' % (username, password)).encode('utf-8')).decode('ascii')
             }
+        self.pool = None
+        self.pool_redirected = False
+        self.requests = 0
+        self.fetch_stats = {}
+        self.upload_stats = {"posted": 0, "lookups": 0}
+        self.lock = threading.Lock()
+        self.bytes_read = 0
+        self.max_response_size = module.params.get('max_response_size') or 0
+        # the pool connects directly, requests that have to go through a proxy are left to fetch_url
+        if pool_size > 0 and not proxyFor(baseurl):
+            self.pool = HTTPConnectionPool(baseurl, pool_size, self.socket_timeout, module.params['validate_certs'])
+            # fetch_url of recent ansible versions decompresses gzip by itself, so only the pool asks for it
+            self.headers['accept-encoding'] = "gzip, deflate"
+        self.limiter = RateLimiter(rate_limit, max_in_flight)
+        self.max_retries = max_retries
+        self.upload_retries = max_retries
+        self.folder_id = None
+        self.tags = []
+        self.retries = 0
+        self.throttled = 0
+        self.started = time.time()
+    
+    def httpStats(self):
+        stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "bytes_on_wire": 0, "bytes_decoded": 0}
+        if self.pool:
+            stats.update(self.pool.stats)
+        # fetch_url opens a connection for each request
+        for k in ("requests", "connections_opened"):
+            stats[k] += self.requests
+        for k in ("bytes_on_wire", "bytes_decoded"):
+            stats[k] += self.bytes_read
+        elapsed = time.time() - self.started
+        stats["retries"] = self.retries
+        stats["throttled"] = self.throttled
+        stats["request_rate"] = round(stats["requests"] / elapsed, 2) if elapsed > 0 else 0
+        stats["concurrency_limit"] = int(self.limiter.limit)
+        return stats
+    
+    def close(self):
+        if self.pool:
+            self.pool.close()
     def getDashboardList(self, search_query):
         if not search_query:
             search_query = ""
         # self.module.fail_json(msg="%s/api/search?query=%s, headers=%s" % (self.baseurl, search_query, self.headers))
-        return self._uri("api/search?query=%s" % search_query, None, "GET")
+        return self._uri("api/search?%s" % urlencode([("query", search_query)] + self.searchFilters()), None, "GET")
+    pass
+    
+    def searchFilters(self):
+        """folder and tag filters of api/search, a dashboard has to match all the tags"""
+        filters = []
+        if self.folder_id is not None:
+            filters.append(("folderIds", self.folder_id))
+        for tag in self.tags:
+            filters.append(("tag", tag))
+        return filters
+    
+    def iterDashboardList(self, search_query, page_size):
+        """yields dash-db search results one page at a time"""
+        seen = set()
+        page = 1
+        while True:
+            query = urlencode([("query", search_query or ""), ("type", "dash-db"), ("limit", page_size), ("page", page)] + self.searchFilters())
+            results = self._uri("api/search?%s" % query, None, "GET")
+            if not results:
+                return
+            new_results = [dash for dash in results if dash["id"] not in seen]
+            if not new_results:
+                # grafana versions without `page` support return the first page again,
+                # that's the whole list only if it wasn't cut at `limit`
+                if len(results) >= page_size:
+                    raise GrafanaError("api/search returned page %d again, grafana ignores `page` and has more than search_page_size (%d) dashboards" % (page, page_size))
+                return
+            for dash in new_results:
+                seen.add(dash["id"])
+                yield dash
+            # a short page doesn't end the list, grafana may cap `limit` below search_page_size
+            page += 1
     pass
     
     def _uri(self, url, body, method):
-        content, status = self._uriWithStatus(url, body, method)
+        content, info = self._uriWithStatus(url, body, method)
+        if info["status"] >= 400:
+            raise GrafanaError("%s %s failed with %s: %s" % (method, url, info["status"], content.get("message", content) if isinstance(content, dict) else content))
         return content
     
-    def _uriWithStatus(self, url, body, method):
-        # is dest is set and is a directory, let's check if we get redirected and
-        # set the filename from that url
-        redirected = False
-        redir_info = {}
-        r = {}
+    def _backoff(self, attempt, info):
+        """seconds to wait before retry `attempt`, grafana's Retry-After wins when it is set"""
+        try:
+            # capped like the backoff, a long Retry-After would stall the whole task
+            return min(30, max(0, float(info.get("retry-after"))))
+        except (TypeError, ValueError):
+            return random.uniform(0.5, 1.0) * min(30, 0.5 * 2 ** (attempt - 1))
+    
+    def _uriWithStatus(self, url, body, method, retries=None):
+        """requests `url`, retrying 429, 5xx and connection errors with jittered exponential backoff"""
+        if retries is None:
+            retries = self.max_retries
         if body:
-            body=json.dumps(body)
-
-        resp, info = fetch_url(self.module, "%s/%s" % (re.sub('/$','',self.baseurl), re.sub('^/','',url)), data=body, headers=self.headers,
-                               method=method, timeout=self.socket_timeout)
-
+            # orjson and ujson don't escape non-ascii, http_client would send a str as latin-1
+            body = jsonDumps(body).encode('utf-8')
+        attempt = 0
+        stream = True
+        while True:
+            self.limiter.acquire()
+            overloaded = True
+            reader = None
+            try:
+                reader, info = self._open(url, body, method)
+                overloaded = info["status"] == 429 or info["status"] >= 500 or info["status"] < 0
+                if not overloaded or attempt >= retries:
+                    return self._decode(reader, url, method, info, stream), info
+            except ResponseTooLarge as e:
+                # not a sign of overload, the limit on requests in flight stays
+                overloaded = False
+                raise GrafanaError("%s %s failed: %s" % (method, url, e))
+            except StreamDecodeError as e:
+                overloaded = False
+                if method != "GET":
+                    raise GrafanaError("%s %s returned invalid JSON: %s" % (method, url, e))
+                # yajl rejects integers beyond 64 bit, the body is requested again and parsed as a whole
+                stream = False
+                continue
+            except (http_client.HTTPException, socket.error, zlib.error) as e:
+                # the connection broke while the body was read, or the body was corrupt
+                overloaded = not isinstance(e, zlib.error)
+                if attempt >= retries:
+                    raise GrafanaError("%s %s failed: %s: %s" % (method, url, type(e).__name__, e))
+                info = {"status": -1, "msg": "%s: %s" % (type(e).__name__, e), "url": url}
+            finally:
+                if reader:
+                    reader.close()
+                self.limiter.release(overloaded)
+            attempt += 1
+            with self.lock:
+                self.retries += 1
+                if info["status"] == 429 or info["status"] >= 500:
+                    self.throttled += 1
+            time.sleep(self._backoff(attempt, info))
+    
+    def _decode(self, reader, url, method, info, stream=True):
+        if reader is None:
+            raise GrafanaError("%s %s failed: %s" % (method, url, info["msg"]))
+        if stream and HAS_IJSON and 200 <= info["status"] < 300:
+            # builds the object straight from the stream, the raw body is never held in memory
+            try:
+                content = next(ijson.items(reader, '', use_float=True))
+            except (ijson.JSONError, StopIteration) as e:
+                raise StreamDecodeError(e)
+            # read up to the end of the body so the connection can be reused
+            reader.read()
+            return content
+        content = reader.read()
         try:
-            content = resp.read()
-        except AttributeError:
-            # there was no content, but the error read()
-            # may have been stored in the info as 'body'
-            content = info.pop('body', '')
-
-        r['redirected'] = redirected or info['url'] != url
-        r.update(redir_info)
-        r.update(info)
-
-        # return r, content, dest
-        return json.loads(content), info
-        # return content
+            return jsonLoads(content)
+        except ValueError:
+            # error pages of grafana or a proxy in front of it are not always json
+            raise GrafanaError("%s %s failed with %s: %s" % (method, url, info["status"], info.get("msg") if not content else content[:200]))
+    
+    def _open(self, url, body, method):
+        """sends the request, returns (ResponseReader, info) with the body still to be read"""
+        reader = None
+        if self.pool and not self.pool_redirected:
+            try:
+                reader, info = self.pool.request(method, re.sub('^/','',url), body, self.headers)
+            except (http_client.HTTPException, socket.error) as e:
+                return None, {"status": -1, "msg": "%s: %s" % (type(e).__name__, e), "url": url}
+            if 300 <= info["status"] < 400:
+                # the pool doesn't follow redirects (e.g. from http:// to https://), fetch_url does
+                reader.close()
+                reader = None
+                self.pool_redirected = True
+            else:
+                reader.max_size = self.max_response_size
+        if reader is None:
+            with self.lock:
+                self.requests += 1
+            headers = dict((k, v) for k, v in self.headers.items() if k != 'accept-encoding')
+            resp, info = fetch_url(self.module, "%s/%s" % (re.sub('/$','',self.baseurl), re.sub('^/','',url)), data=body, headers=headers,
+                                   method=method, timeout=self.socket_timeout)
+            if resp is None:
+                # there was no content, but the error read()
+                # may have been stored in the info as 'body'
+                content = info.pop('body', b'') or b''
+                resp = io.BytesIO(content if isinstance(content, bytes) else content.encode('utf-8'))
+            reader = ResponseReader(resp, self._fetchUrlDone, '', self.max_response_size)
+        content_length = info.get("content-length")
+        if self.max_response_size and content_length and not reader.encoding and int(content_length) > self.max_response_size:
+            reader.close()
+            raise ResponseTooLarge("response is larger than max_response_size (%d bytes)" % self.max_response_size)
+        return reader, info
+    
+    def _fetchUrlDone(self, reader):
+        with self.lock:
+            self.bytes_read += reader.decoded_bytes
         
     def getDashboardByUri(self, uri):
-        grafana_dashboard = self._uri("api/dashboards/%s" % uri, None, "GET")
+        return self.dashboardResult(self._uri("api/dashboards/%s" % uri, None, "GET"))
+    pass
+    
+    def dashboardResult(self, grafana_dashboard):
         grafana_dashboard["meta"]["id"] = grafana_dashboard["dashboard"]["id"]
         dashboard_result = {}
         for k in ["updated", "id", "version", "slug"]:
@@ -118,29 +533,250 @@ class Grafana:
         return dashboard_result
     pass
     
-    def postDashboard(self, dashboard):
-        # self.module.fail_json(msg="dashboard slug=%s, keys=%s" % (dashboard["slug"], dashboard.keys()))
-        post_result = self._uri("api/dashboards/db", { "overwrite": True, "dashboard": dashboard["dashboard"] } , "POST")
+    def getDashboardVersion(self, dash_id):
+        versions = self._uri("api/dashboards/id/%s/versions?limit=1" % dash_id, None, "GET")
+        if isinstance(versions, dict):
+            versions = versions.get("versions", [])
+        return versions[0]["version"]
+    
+    def unchangedDashboard(self, dash, version):
+        """metadata-only stand-in for a dashboard whose version matches the mapping"""
+        dashboard_result = {
+            "id": dash["id"],
+            "version": version,
+            "slug": re.sub('^db/', '', dash["uri"]),
+            "unchanged": True,
+        }
+        dashboard_result["dashboard"] = {"id": dash["id"], "title": dash["title"], "version": version}
+        return dashboard_result
+    
+    def _fetchDashboard(self, dash, known_versions):
+        try:
+            known_version = known_versions.get(str(dash["id"]))
+            if known_version is not None:
+                try:
+                    version = self.getDashboardVersion(dash["id"])
+                except Exception:
+                    # no version history available, fall back to the full body
+                    version = None
+                if version == known_version:
+                    return dash["uri"], self.unchangedDashboard(dash, version), None
+            return dash["uri"], self.getDashboardByUri(dash["uri"]), None
+        except Exception as e:
+            return dash["uri"], None, "%s: %s" % (type(e).__name__, e)
+    
+    def _iterDashDb(self, dashboard_list):
+        # pool.imap consumes this in its own thread, errors are handed over through self.list_error
+        try:
+            for dash in dashboard_list:
+                if dash["type"] == "dash-db":
+                    self.fetch_stats["listed"] += 1
+                    yield dash
+        except Exception as e:
+            self.list_error = e
+    
+    def getDashboards(self, dashboard_list, concurrency=1, known_versions=None):
+        """fetches dash-db dashboards with up to `concurrency` parallel requests, keyed by slug
+        
+        `dashboard_list` may be a generator, bodies are fetched while it is still being listed.
+        dashboards listed in `known_versions` ({remote id: version}) are only fetched in full
+        when their remote version differs
+        """
+        dashboards = {}
+        self.fetch_stats = {"listed": 0, "fetched": 0, "unchanged": 0}
+        self.list_error = None
+        errors = []
+        pool = ThreadPool(max(1, concurrency))
+        try:
+            # imap keeps the listing order so slug collisions resolve like the serial loop did
+            for uri, dashboard, error in pool.imap(functools.partial(self._fetchDashboard, known_versions=known_versions or {}), self._iterDashDb(dashboard_list)):
+                if error:
+                    errors.append("%s (%s)" % (uri, error))
+                else:
+                    dashboards[dashboard["slug"]] = dashboard
+                    self.fetch_stats["unchanged" if dashboard.get("unchanged") else "fetched"] += 1
+        finally:
+            pool.close()
+            pool.join()
+        if self.list_error:
+            raise GrafanaError("Failed to list dashboards: %s: %s" % (type(self.list_error).__name__, self.list_error))
+        if errors:
+            raise GrafanaError("Failed to fetch %d dashboard(s): %s" % (len(errors), ", ".join(errors)))
+        return dashboards
+    pass
+    
+    def findDashboardId(self, slug, title):
+        query = urlencode([("query", title), ("type", "dash-db")])
+        for dash in self._uri("api/search?%s" % query, None, "GET"):
+            if dash["uri"] == "db/%s" % slug:
+                return dash["id"]
+        raise GrafanaError("Dashboard %s not found after upload" % slug)
+    
+    def fetchDashboards(self, search_query, page_size, concurrency=1, known_versions=None):
+        return self.getDashboards(self.iterDashboardList(search_query, page_size), concurrency, known_versions)
+    pass
+    
+    def missingDashboardIds(self, ids, chunk_size=100):
+        """ids that are not found on the instance anymore, None when grafana doesn't support `dashboardIds`"""
+        found = set()
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            query = urlencode([("type", "dash-db"), ("limit", len(chunk) + 1)] + [("dashboardIds", dash_id) for dash_id in chunk])
+            results = [dash["id"] for dash in self._uri("api/search?%s" % query, None, "GET")]
+            if set(results) - set(chunk):
+                # the filter was ignored, nothing can be told about the ids
+                return None
+            found.update(results)
+        return [dash_id for dash_id in ids if dash_id not in found]
+    
+    def postResult(self, dashboard, post_result, info):
+        """validates a POST api/dashboards/db response, returns the post result fields it has"""
         if "status" not in post_result:
-            self.module.fail_json(msg="Dashboard upload failed with unexpected responce: %s" % post_result)
+            raise GrafanaError("Dashboard upload failed with unexpected responce: %s" % post_result)
         elif post_result["status"] != "success":
-            self.module.fail_json(msg="Dashboard upload failed: %s, %s" % (post_result["status"], post_result["message"]))
+            raise GrafanaError("Dashboard upload failed: %s, %s" % (post_result["status"], post_result["message"]))
         elif "slug" not in post_result:
-            self.module.fail_json(msg="Dashboard upload failed: unexpected responce, 'slug' not found: %s" % post_result)
+            raise GrafanaError("Dashboard upload failed: unexpected responce, 'slug' not found: %s" % post_result)
         elif post_result["slug"] != dashboard["slug"]:
-            self.module.fail_json(msg="Dashboard upload error: slugs do not match, expected '%s', got '%s'" % (dashboard["slug"], post_result["slug"]))
-        dashboard = self.getDashboardByUri("db/%s" % post_result["slug"])
-        dashboard.pop("dashboard", None)
-        return dashboard
+            raise GrafanaError("Dashboard upload error: slugs do not match, expected '%s', got '%s'" % (dashboard["slug"], post_result["slug"]))
+        # grafana returns id (since 5.0) and version but not `updated`, the response date stands in for it
+        result = {"slug": post_result["slug"], "updated": grafanaTimestamp(info.get("date"))}
+        for k in ["id", "version"]:
+            if k in post_result:
+                result[k] = post_result[k]
+        return result
+    
+    def postBody(self, dashboard):
+        body = { "overwrite": True, "dashboard": dashboard["dashboard"] }
+        if self.folder_id is not None:
+            body["folderId"] = self.folder_id
+        return body
+    
+    def postDashboard(self, dashboard):
+        # self.module.fail_json(msg="dashboard slug=%s, keys=%s" % (dashboard["slug"], dashboard.keys()))
+        post_result, info = self._uriWithStatus("api/dashboards/db", self.postBody(dashboard), "POST", self.upload_retries)
+        result = self.postResult(dashboard, post_result, info)
+        if "id" not in result:
+            self.countUpload("lookups")
+            result["id"] = self.findDashboardId(result["slug"], dashboard["dashboard"]["title"])
+        if "version" not in result:
+            self.countUpload("lookups")
+            result["version"] = self.getDashboardVersion(result["id"])
+        self.countUpload("posted")
+        return result
+    pass
+    
+    def countUpload(self, key):
+        with self.lock:
+            self.upload_stats[key] += 1
+    
+    def _postDashboard(self, slug, dashboards_dict):
+        try:
+            return slug, self.postDashboard(dashboards_dict[slug]), None
+        except Exception as e:
+            return slug, None, str(e) if isinstance(e, GrafanaError) else "%s: %s" % (type(e).__name__, e)
+    
+    def postDashboards(self, dashboards_dict, concurrency=1):
+        """uploads dashboards with up to `concurrency` parallel requests
+        
+        returns post results of the uploaded dashboards and errors of the failed ones, keyed by slug
+        """
+        post_results = {}
+        upload_failures = {}
+        if not dashboards_dict:
+            return post_results, upload_failures
+        pool = ThreadPool(max(1, min(concurrency, len(dashboards_dict))))
+        try:
+            # dashboards don't depend on each other, so they are posted in whatever order completes first
+            for slug, post_result, error in pool.imap_unordered(functools.partial(self._postDashboard, dashboards_dict=dashboards_dict), list(dashboards_dict)):
+                if error:
+                    upload_failures[slug] = error
+                else:
+                    post_results[slug] = post_result
+        finally:
+            pool.close()
+            pool.join()
+        return post_results, upload_failures
     pass
     
     def deleteDashboard(self, slug):
-        res, info = self._uriWithStatus("api/dashboards/db/%s" % slug, None , "DELETE")
-        if info["status"] != 200:
-            self.module.fail_json(msg=info)
-        return res
+        """returns (slug, {"status", "latency"[, "msg"]}), failures are reported, not raised"""
+        started = time.time()
+        try:
+            res, info = self._uriWithStatus("api/dashboards/db/%s" % slug, None , "DELETE")
+            result = {"status": info["status"]}
+            if info["status"] != 200:
+                result["msg"] = res.get("message", info.get("msg")) if isinstance(res, dict) else info.get("msg")
+        except Exception as e:
+            result = {"status": -1, "msg": "%s: %s" % (type(e).__name__, e)}
+        result["latency"] = round(time.time() - started, 3)
+        return slug, result
     pass
     
+    def deleteDashboards(self, slugs, concurrency=1):
+        delete_results = {}
+        if not slugs:
+            return delete_results
+        pool = ThreadPool(max(1, min(concurrency, len(slugs))))
+        try:
+            for slug, result in pool.imap_unordered(self.deleteDashboard, slugs):
+                delete_results[slug] = result
+        finally:
+            pool.close()
+            pool.join()
+        return delete_results
+    pass
+    
+    def pushDashboards(self, dashboards_dict, slugs, upload_concurrency=1, delete_concurrency=1):
+        """uploads and then deletes, returns post results, upload failures and delete results"""
+        post_results, upload_failures = self.postDashboards(dashboards_dict, upload_concurrency)
+        return post_results, upload_failures, self.deleteDashboards(slugs, delete_concurrency)
+    pass
+    
+
+def grafanaClient(module, url, username, password):
+    grafana = Grafana(module, url, username, password, module.params['pool_size'],
+                      module.params['rate_limit'], max(module.params['fetch_concurrency'], module.params['upload_concurrency'], module.params['delete_concurrency']),
+                      module.params['max_retries'])
+    grafana.upload_retries = module.params['upload_retries']
+    grafana.folder_id = module.params['folder_id']
+    grafana.tags = module.params['tags']
+    if module.params['engine'] == 'async':
+        grafana = AsyncGrafana(grafana, GrafanaError)
+    return grafana
+
+def syncActions(module, grafana, action_args):
+    """fetch, upload and delete phases of the sync action"""
+    result = {}
+    if action_args.get("get_dashboards"):
+        result["dashboards"] = grafana.fetchDashboards(module.params['search_query'], module.params['search_page_size'], module.params['fetch_concurrency'], action_args.get("known_versions"))
+        result["fetch_stats"] = grafana.fetch_stats
+        if action_args.get("check_ids"):
+            # tells dashboards deleted on the instance from ones moved out of a shard or skipped by shifted pages
+            listed = set(dash["id"] for dash in result["dashboards"].values())
+            result["missing_ids"] = grafana.missingDashboardIds([dash_id for dash_id in action_args["check_ids"] if dash_id not in listed])
+    if action_args.get("upload_dashboards") or action_args.get("delete_dashboards"):
+        post_results, upload_failures, delete_results = grafana.pushDashboards(action_args.get("upload_dashboards") or {}, action_args.get("delete_dashboards") or [],
+                                                                               module.params['upload_concurrency'], module.params['delete_concurrency'])
+        if action_args.get("upload_dashboards"):
+            result["post_results"], result["upload_failures"] = post_results, upload_failures
+            result["upload_stats"] = grafana.upload_stats
+        if action_args.get("delete_dashboards"):
+            result["delete_results"] = delete_results
+    return result
+
+def syncInstance(module, instance, instances_args):
+    """sync action against one of `instances`, a failing instance doesn't stop the others"""
+    grafana = grafanaClient(module, instance["url"] or module.params['url'], instance["username"] or module.params['username'],
+                            instance["password"] or module.params['password'])
+    try:
+        result = syncActions(module, grafana, instances_args[instance["name"]])
+    except GrafanaError as e:
+        result = {"failed": True, "msg": str(e)}
+    finally:
+        grafana.close()
+    result["http_stats"] = grafana.httpStats()
+    return instance["name"], result
 
 def main():
     module = AnsibleModule(
@@ -152,6 +788,26 @@ def main():
             password = dict(type='str', no_log=True),
             search_query = dict(required=False),
             mapping_dir = dict(),
+            fetch_concurrency = dict(default=8, type='int'),
+            pool_size = dict(default=8, type='int'),
+            validate_certs = dict(default=True, type='bool'),
+            incremental = dict(default=False, type='bool'),
+            search_page_size = dict(default=1000, type='int'),
+            delete_concurrency = dict(default=8, type='int'),
+            upload_concurrency = dict(default=8, type='int'),
+            upload_retries = dict(default=2, type='int'),
+            rate_limit = dict(default=0, type='float'),
+            max_retries = dict(default=3, type='int'),
+            max_response_size = dict(default=0, type='int'),
+            folder_id = dict(required=False, type='int'),
+            tags = dict(default=[], type='list', elements='str'),
+            instances = dict(default=[], type='list', elements='dict', options=dict(
+                name = dict(required=True),
+                url = dict(),
+                username = dict(type='str'),
+                password = dict(type='str', no_log=True),
+            )),
+            engine = dict(default='sync', choices=['sync', 'async']),
             run_tests = dict(default=False, choices=[True, False], type='bool'),
             action = dict(required=False, type='str'),
             action_args = dict(required=False),
@@ -160,39 +816,49 @@ def main():
     )
     
     action = module.params['action']
-    action_args = json.loads(module.params['action_args'])
+    action_args = jsonLoads(module.params['action_args'])
     run_tests = module.params['run_tests']
     local_path = module.params['path']
     search_query = module.params['search_query']
     if action:
         if action == "slug":
-            slugged = {}
-            for name in action_args:
-                slugged[name] = slugify(name)
-            module.exit_json(changed=False, slugged=slugged)
-        elif action == "get_dashboards":
-            grafana = Grafana(module, module.params['url'],module.params['username'], module.params['password'])
-            dashboard_list = grafana.getDashboardList(search_query)
-            dashboards = {}
-            for dash in dashboard_list:
-                if dash["type"] == "dash-db":
-                    dashboard = grafana.getDashboardByUri(dash["uri"])
-                    dashboards[dashboard["slug"]] = dashboard
-            module.exit_json(changed=False, dashboards=dashboards)
-        elif action == "upload_dashboards":
-            grafana = Grafana(module, module.params['url'],module.params['username'], module.params['password'])
-            post_results = {}
-            dashboards_dict = action_args
-            for slug in dashboards_dict:
-                post_results[slug] = grafana.postDashboard(dashboards_dict[slug])
-            module.exit_json(changed=True, post_results=post_results)
-        elif action == "delete_dashboards":
-            grafana = Grafana(module, module.params['url'],module.params['username'], module.params['password'])
-            delete_results = {}
-            for slug in action_args:
-                r = grafana.deleteDashboard(slug)
-                delete_results[slug] = r
-        module.exit_json(changed=True, delete_results=delete_results)
+            module.exit_json(changed=False, slugged=slugTitles(action_args))
+        if module.params['engine'] == 'async' and not HAS_ASYNC:
+            module.fail_json(msg="engine 'async' requires python 3.6+ and aiohttp on the target")
+        grafana = grafanaClient(module, module.params['url'], module.params['username'], module.params['password'])
+        result = {}
+        try:
+            if action == "get_dashboards":
+                result["dashboards"] = grafana.fetchDashboards(search_query, module.params['search_page_size'], module.params['fetch_concurrency'], action_args.get("known_versions"))
+                result["fetch_stats"] = grafana.fetch_stats
+            elif action == "upload_dashboards":
+                result["post_results"], result["upload_failures"] = grafana.postDashboards(action_args, module.params['upload_concurrency'])
+                result["upload_stats"] = grafana.upload_stats
+            elif action == "delete_dashboards":
+                result["delete_results"] = grafana.deleteDashboards(action_args, module.params['delete_concurrency'])
+            elif action == "sync":
+                # any combination of the actions above in one run, so the action plugin
+                # does not have to re-launch the module for each of them
+                if "slug" in action_args:
+                    result["slugged"] = slugTitles(action_args["slug"])
+                if module.params['instances']:
+                    # action_args["instances"] holds the actions of each instance, keyed by name
+                    instances = [i for i in module.params['instances'] if i["name"] in action_args.get("instances", {})]
+                    pool = ThreadPool(max(1, len(instances)))
+                    try:
+                        result["instances"] = dict(pool.map(functools.partial(syncInstance, module, instances_args=action_args["instances"]), instances))
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    result.update(syncActions(module, grafana, action_args))
+            else:
+                module.fail_json(msg="Unknown action %s" % action)
+        except GrafanaError as e:
+            module.fail_json(msg=str(e))
+        grafana.close()
+        changed = any("post_results" in r or "delete_results" in r for r in [result] + list(result.get("instances", {}).values()))
+        module.exit_json(changed=changed, http_stats=grafana.httpStats(), json_backend=JSON_BACKEND, **result)
     if run_tests:
         ok, info = slug_test_pass()
         if not ok:
@@ -206,7 +872,7 @@ def main():
     #         module.fail_json(msg=e.message)
     #     module.fail_json(msg=result)
     
-    grafana = Grafana(module, module.params['url'],module.params['username'], module.params['password'])
+    grafana = Grafana(module, module.params['url'],module.params['username'], module.params['password'], module.params['pool_size'])
     resp = grafana.getDashboardList(search_query)
     # module.fail_json(msg="responce=%s" % resp)
     module.fail_json(msg=local_path)
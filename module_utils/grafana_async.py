@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""asyncio engine of the grafana_dashboard_sync module
+
+Python 3.6+ and aiohttp only, the module imports it conditionally so it keeps
+working on older interpreters with the default engine.
+"""
+
+import asyncio
+import time
+from urllib.parse import urlencode
+
+from ansible.module_utils.grafana_json import jsonDumps, jsonLoads
+
+try:
+    import aiohttp
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+
+class AsyncGrafana:
+    """runs listing, fetching, uploads and deletes as tasks on a single event loop
+
+    `grafana` is the synchronous client, its settings (headers, retries, limits)
+    and response helpers are reused so both engines return the same results,
+    `error` is the exception class raised for failed requests
+    """
+    chunk_size = 65536
+
+    def __init__(self, grafana, error):
+        self.grafana = grafana
+        self.error = error
+        self.baseurl = grafana.baseurl.rstrip('/')
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.fetch_stats = {}
+        self.upload_stats = {"posted": 0, "lookups": 0}
+        self.stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "bytes_decoded": 0}
+        self.retries = 0
+        self.throttled = 0
+        self.next_slot = 0
+        self.started = time.time()
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def _connectionOpened(self, session, context, params):
+        self.stats["connections_opened"] += 1
+
+    async def _connectionReused(self, session, context, params):
+        self.stats["connections_reused"] += 1
+
+    async def _session(self):
+        if self.session is None:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self._connectionOpened)
+            trace.on_connection_reuseconn.append(self._connectionReused)
+            # aiohttp negotiates and decodes compression by itself
+            headers = dict((k, v) for k, v in self.grafana.headers.items() if k != 'accept-encoding')
+            connector = aiohttp.TCPConnector(limit=self.grafana.limiter.max_in_flight,
+                                             ssl=None if self.grafana.module.params['validate_certs'] else False)
+            # trust_env picks up http_proxy, https_proxy and no_proxy like fetch_url does
+            self.session = aiohttp.ClientSession(headers=headers, connector=connector, trace_configs=[trace], trust_env=True,
+                                                 timeout=aiohttp.ClientTimeout(total=self.grafana.socket_timeout))
+        return self.session
+
+    async def _pace(self):
+        """spaces requests out to `rate_limit` per second"""
+        rate = self.grafana.limiter.rate
+        if rate <= 0:
+            return
+        now = time.time()
+        self.next_slot = max(now, self.next_slot + 1.0 / rate)
+        if self.next_slot > now:
+            await asyncio.sleep(self.next_slot - now)
+
+    async def _read(self, resp, method, url):
+        chunks = []
+        size = 0
+        async for chunk in resp.content.iter_chunked(self.chunk_size):
+            size += len(chunk)
+            if self.grafana.max_response_size and size > self.grafana.max_response_size:
+                raise self.error("%s %s failed: response is larger than max_response_size (%d bytes)" % (method, url, self.grafana.max_response_size))
+            chunks.append(chunk)
+        self.stats["bytes_decoded"] += size
+        return b''.join(chunks)
+
+    async def _uriWithStatus(self, url, body, method, retries=None):
+        if retries is None:
+            retries = self.grafana.max_retries
+        session = await self._session()
+        if body:
+            body = jsonDumps(body).encode('utf-8')
+        attempt = 0
+        while True:
+            await self._pace()
+            self.stats["requests"] += 1
+            try:
+                async with session.request(method, "%s/%s" % (self.baseurl, url.lstrip('/')), data=body) as resp:
+                    info = dict((k.lower(), v) for k, v in resp.headers.items())
+                    info.update({"status": resp.status, "msg": resp.reason, "url": str(resp.url)})
+                    overloaded = resp.status == 429 or resp.status >= 500
+                    if not overloaded or attempt >= retries:
+                        content = await self._read(resp, method, url)
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= retries:
+                    raise self.error("%s %s failed: %s: %s" % (method, url, type(e).__name__, e))
+                info = {"status": -1, "msg": "%s: %s" % (type(e).__name__, e), "url": url}
+            attempt += 1
+            self.retries += 1
+            if info["status"] == 429 or info["status"] >= 500:
+                self.throttled += 1
+            await asyncio.sleep(self.grafana._backoff(attempt, info))
+        try:
+            return jsonLoads(content), info
+        except ValueError:
+            raise self.error("%s %s failed with %s: %s" % (method, url, info["status"], info.get("msg") if not content else content[:200]))
+
+    async def _uri(self, url, body=None, method="GET"):
+        content, info = await self._uriWithStatus(url, body, method)
+        if info["status"] >= 400:
+            raise self.error("%s %s failed with %s: %s" % (method, url, info["status"], content.get("message", content) if isinstance(content, dict) else content))
+        return content
+
+    async def _iterDashboardList(self, search_query, page_size):
+        seen = set()
+        page = 1
+        while True:
+            query = urlencode([("query", search_query or ""), ("type", "dash-db"), ("limit", page_size), ("page", page)] + self.grafana.searchFilters())
+            results = await self._uri("api/search?%s" % query)
+            if not results:
+                return
+            new_results = [dash for dash in results if dash["id"] not in seen]
+            if not new_results:
+                # see Grafana.iterDashboardList
+                if len(results) >= page_size:
+                    raise self.error("api/search returned page %d again, grafana ignores `page` and has more than search_page_size (%d) dashboards" % (page, page_size))
+                return
+            for dash in new_results:
+                seen.add(dash["id"])
+                if dash["type"] == "dash-db":
+                    yield dash
+            page += 1
+
+    async def _getDashboardVersion(self, dash_id):
+        versions = await self._uri("api/dashboards/id/%s/versions?limit=1" % dash_id)
+        if isinstance(versions, dict):
+            versions = versions.get("versions", [])
+        return versions[0]["version"]
+
+    async def _fetchDashboard(self, dash, known_versions, semaphore):
+        async with semaphore:
+            try:
+                known_version = known_versions.get(str(dash["id"]))
+                if known_version is not None:
+                    try:
+                        version = await self._getDashboardVersion(dash["id"])
+                    except Exception:
+                        version = None
+                    if version == known_version:
+                        return dash["uri"], self.grafana.unchangedDashboard(dash, version), None
+                content = await self._uri("api/dashboards/%s" % dash["uri"])
+                return dash["uri"], self.grafana.dashboardResult(content), None
+            except Exception as e:
+                return dash["uri"], None, "%s: %s" % (type(e).__name__, e)
+
+    async def _fetchDashboards(self, search_query, page_size, concurrency, known_versions):
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        tasks = []
+        try:
+            # bodies are requested while later search pages are still coming in
+            async for dash in self._iterDashboardList(search_query, page_size):
+                tasks.append(asyncio.ensure_future(self._fetchDashboard(dash, known_versions or {}, semaphore)))
+        except Exception as e:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise self.error("Failed to list dashboards: %s: %s" % (type(e).__name__, e))
+        return await asyncio.gather(*tasks)
+
+    def fetchDashboards(self, search_query, page_size, concurrency=1, known_versions=None):
+        results = self._run(self._fetchDashboards(search_query, page_size, concurrency, known_versions))
+        dashboards = {}
+        self.fetch_stats = {"listed": len(results), "fetched": 0, "unchanged": 0}
+        errors = []
+        for uri, dashboard, error in results:
+            if error:
+                errors.append("%s (%s)" % (uri, error))
+            else:
+                dashboards[dashboard["slug"]] = dashboard
+                self.fetch_stats["unchanged" if dashboard.get("unchanged") else "fetched"] += 1
+        if errors:
+            raise self.error("Failed to fetch %d dashboard(s): %s" % (len(errors), ", ".join(errors)))
+        return dashboards
+
+    async def _missingDashboardIds(self, ids, chunk_size):
+        found = set()
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            query = urlencode([("type", "dash-db"), ("limit", len(chunk) + 1)] + [("dashboardIds", dash_id) for dash_id in chunk])
+            results = [dash["id"] for dash in await self._uri("api/search?%s" % query)]
+            if set(results) - set(chunk):
+                # the filter was ignored, nothing can be told about the ids
+                return None
+            found.update(results)
+        return [dash_id for dash_id in ids if dash_id not in found]
+
+    def missingDashboardIds(self, ids, chunk_size=100):
+        return self._run(self._missingDashboardIds(ids, chunk_size))
+
+    async def _findDashboardId(self, slug, title):
+        query = urlencode([("query", title), ("type", "dash-db")])
+        for dash in await self._uri("api/search?%s" % query):
+            if dash["uri"] == "db/%s" % slug:
+                return dash["id"]
+        raise self.error("Dashboard %s not found after upload" % slug)
+
+    async def _postDashboard(self, slug, dashboard, semaphore):
+        async with semaphore:
+            try:
+                post_result, info = await self._uriWithStatus("api/dashboards/db", self.grafana.postBody(dashboard), "POST", self.grafana.upload_retries)
+                result = self.grafana.postResult(dashboard, post_result, info)
+                if "id" not in result:
+                    self.upload_stats["lookups"] += 1
+                    result["id"] = await self._findDashboardId(result["slug"], dashboard["dashboard"]["title"])
+                if "version" not in result:
+                    self.upload_stats["lookups"] += 1
+                    result["version"] = await self._getDashboardVersion(result["id"])
+                self.upload_stats["posted"] += 1
+                return slug, result, None
+            except Exception as e:
+                return slug, None, str(e) if isinstance(e, self.error) else "%s: %s" % (type(e).__name__, e)
+
+    async def _postDashboards(self, dashboards_dict, concurrency):
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        post_results = {}
+        upload_failures = {}
+        for future in asyncio.as_completed([self._postDashboard(slug, dashboards_dict[slug], semaphore) for slug in dashboards_dict]):
+            slug, post_result, error = await future
+            if error:
+                upload_failures[slug] = error
+            else:
+                post_results[slug] = post_result
+        return post_results, upload_failures
+
+    def postDashboards(self, dashboards_dict, concurrency=1):
+        return self._run(self._postDashboards(dashboards_dict, concurrency))
+
+    async def _deleteDashboard(self, slug, semaphore):
+        async with semaphore:
+            started = time.time()
+            try:
+                res, info = await self._uriWithStatus("api/dashboards/db/%s" % slug, None, "DELETE")
+                result = {"status": info["status"]}
+                if info["status"] != 200:
+                    result["msg"] = res.get("message", info.get("msg")) if isinstance(res, dict) else info.get("msg")
+            except Exception as e:
+                result = {"status": -1, "msg": "%s: %s" % (type(e).__name__, e)}
+            result["latency"] = round(time.time() - started, 3)
+            return slug, result
+
+    async def _deleteDashboards(self, slugs, concurrency):
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        return dict(await asyncio.gather(*[self._deleteDashboard(slug, semaphore) for slug in slugs]))
+
+    def deleteDashboards(self, slugs, concurrency=1):
+        return self._run(self._deleteDashboards(slugs, concurrency))
+
+    async def _pushDashboards(self, dashboards_dict, slugs, upload_concurrency, delete_concurrency):
+        (post_results, upload_failures), delete_results = await asyncio.gather(
+            self._postDashboards(dashboards_dict, upload_concurrency),
+            self._deleteDashboards(slugs, delete_concurrency))
+        return post_results, upload_failures, delete_results
+
+    def pushDashboards(self, dashboards_dict, slugs, upload_concurrency=1, delete_concurrency=1):
+        """uploads and deletes at the same time"""
+        return self._run(self._pushDashboards(dashboards_dict, slugs, upload_concurrency, delete_concurrency))
+
+    def httpStats(self):
+        stats = dict(self.stats)
+        elapsed = time.time() - self.started
+        stats["retries"] = self.retries
+        stats["throttled"] = self.throttled
+        stats["request_rate"] = round(stats["requests"] / elapsed, 2) if elapsed > 0 else 0
+        stats["concurrency_limit"] = self.grafana.limiter.max_in_flight
+        return stats
+
+    def close(self):
+        if self.session is not None:
+            self._run(self.session.close())
+        self.loop.close()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""JSON backend of the grafana_dashboard_sync module
+
+orjson or ujson are used when installed on the target, they only serve
+compact payloads and parsing, files are written by the action plugin.
+"""
+
+import json
+import re
+
+# digit runs this long may not fit 64 bits, orjson parses such integers as floats,
+# documents holding one are parsed by the json module so they are saved unchanged
+LONG_INT_RE = re.compile(r'[0-9]{19}')
+LONG_INT_BYTES_RE = re.compile(b'[0-9]{19}')
+
+
+def needsExactLoads(data):
+    """True when `data` may hold numbers the fast backends don't parse exactly"""
+    return (LONG_INT_BYTES_RE if isinstance(data, bytes) else LONG_INT_RE).search(data) is not None
+
+
+try:
+    import orjson
+    JSON_BACKEND = 'orjson'
+
+    def jsonLoads(data):
+        if needsExactLoads(data):
+            return json.loads(data)
+        return orjson.loads(data)
+
+    def jsonDumps(obj):
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # non-string keys or integers beyond 64 bit
+            return json.dumps(obj)
+except ImportError:
+    try:
+        import ujson
+        JSON_BACKEND = 'ujson'
+
+        def jsonLoads(data):
+            if needsExactLoads(data):
+                return json.loads(data)
+            return ujson.loads(data)
+
+        def jsonDumps(obj):
+            try:
+                return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+            except (OverflowError, TypeError):
+                # integers beyond 64 bit with older ujson versions
+                return json.dumps(obj)
+    except ImportError:
+        JSON_BACKEND = 'json'
+        jsonLoads = json.loads
+
+        def jsonDumps(obj):
+            return json.dumps(obj)